@@ -3,31 +3,223 @@ title: Max Turns Filter
 author: OVINC CN
 git_url: https://github.com/OVINC-CN/OpenWebUIPlugin.git
 description: Max Turns Filter
-version: 0.0.1
+version: 0.0.4
 licence: MIT
 """
 
+import asyncio
+import hashlib
+import json
 import logging
-from typing import Optional
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+from typing import List, Optional, Tuple
 
+import httpx
+from open_webui.env import REDIS_SENTINEL_HOSTS, REDIS_SENTINEL_PORT, REDIS_URL
+from open_webui.utils.redis import get_redis_connection, get_sentinels_from_env
 from pydantic import BaseModel, Field
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+SUMMARY_PROMPT = (
+    "Summarize the following conversation between a user and an assistant. "
+    "Keep every fact, decision, requirement, name, number and open question that later turns may rely on. "
+    "Reply with the summary only."
+)
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+IMAGE_PLACEHOLDER = "[image omitted]"
+
+
+class SummaryStore:
+    def __init__(self, prefix: str, max_items: int = 1024):
+        self.prefix = prefix
+        self.max_items = max_items
+        self._items: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = get_redis_connection(
+            redis_url=REDIS_URL,
+            redis_sentinels=get_sentinels_from_env(REDIS_SENTINEL_HOSTS, REDIS_SENTINEL_PORT),
+            decode_responses=True,
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        key = f"{self.prefix}:{key}"
+        # shared store
+        if self._redis is not None:
+            try:
+                return self._redis.get(key)
+            except Exception as err:
+                logger.warning("[SummaryStore] redis get failed: %s", err)
+        # local store
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[1] < time.time():
+                self._items.pop(key, None)
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        key = f"{self.prefix}:{key}"
+        # shared store
+        if self._redis is not None:
+            try:
+                self._redis.set(key, value, ex=ttl)
+                return
+            except Exception as err:
+                logger.warning("[SummaryStore] redis set failed: %s", err)
+        # local store
+        with self._lock:
+            self._items[key] = (value, time.time() + ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
 
 class Filter:
     class Valves(BaseModel):
         priority: int = Field(default=0, description="filter priority")
-        max_turns: int = Field(default=16, description="maximum conversation turns")
+        max_turns: int = Field(
+            default=16, description="maximum conversation turns, ignored when compaction runs with a summary model"
+        )
+        enable_compaction: bool = Field(
+            default=False,
+            description="compact history on every turn, replaces the max turns limit once summary model is set",
+        )
+        keep_turns: int = Field(default=4, description="recent turns kept verbatim when compacting", ge=1)
+        compact_step: int = Field(default=4, description="turns folded into the summary at a time", ge=1)
+        keep_image_turns: int = Field(default=1, description="recent turns whose inline images are kept", ge=0)
+        summary_base_url: str = Field(default="https://api.openai.com/v1", description="summary api base url")
+        summary_api_key: str = Field(default="", description="summary api key")
+        summary_model: str = Field(default="", description="summary model, required for compaction")
+        summary_timeout: int = Field(default=60, description="summary request timeout in seconds")
+        summary_cache_size: int = Field(
+            default=1024, description="maximum cached summaries when redis is unavailable", ge=1
+        )
+        summary_cache_ttl: int = Field(default=7, description="cached summary lifetime in days", ge=1)
 
     def __init__(self):
         self.valves = self.Valves()
+        # shared by every worker through redis, so a summary is only requested once
+        self.summaries = SummaryStore(prefix="max_turns_limit:summary")
 
-    def inlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
+    async def inlet(self, body: dict, __user__: Optional[dict] = None) -> dict:
         __user__ = __user__ or {}
-        current_turns = len(body.get("messages", [])) // 2
+        messages = body.get("messages", [])
+        current_turns = len(messages) // 2
+        # without a summary model older turns would be lost, keep enforcing the limit instead
+        if self.valves.enable_compaction and self.valves.summary_model:
+            body["messages"] = await self._compact(messages)
+            return body
         if current_turns >= self.valves.max_turns:
             logger.info("[max_turns_reached] %s", __user__.get("id"))
             raise Exception(f"max turns ({self.valves.max_turns}) reached, new conversation required")
         return body
+
+    async def _compact(self, messages: List[dict]) -> List[dict]:
+        system_messages = [m for m in messages if m["role"] == "system"]
+        chat_messages = [m for m in messages if m["role"] != "system"]
+
+        # strip images outside the recent turns
+        image_boundary = len(chat_messages) - self.valves.keep_image_turns * 2
+        chat_messages = [
+            self._strip_images(message) if index < image_boundary else message
+            for index, message in enumerate(chat_messages)
+        ]
+
+        # fold older turns by whole steps so that the summary only changes every few turns
+        step = self.valves.compact_step * 2
+        older_count = len(chat_messages) - self.valves.keep_turns * 2
+        boundary = max(older_count, 0) // step * step
+        if boundary <= 0:
+            return system_messages + chat_messages
+
+        summary = await self._summarize(chat_messages[:boundary], step)
+        if not summary:
+            return system_messages + chat_messages
+        return (
+            system_messages + [{"role": "system", "content": f"{SUMMARY_PREFIX}{summary}"}] + chat_messages[boundary:]
+        )
+
+    async def _summarize(self, messages: List[dict], step: int) -> str:
+        if not self.valves.summary_model:
+            return ""
+        messages = [self._strip_images(message) for message in messages]
+
+        # cached summary
+        loop = asyncio.get_running_loop()
+        self.summaries.max_items = self.valves.summary_cache_size
+        cache_key = self._hash(messages)
+        summary = await loop.run_in_executor(None, self.summaries.get, cache_key)
+        if summary:
+            return summary
+
+        # extend the previous summary with the new step when possible
+        previous_key = self._hash(messages[:-step]) if len(messages) > step else ""
+        previous = await loop.run_in_executor(None, self.summaries.get, previous_key) if previous_key else None
+        if previous:
+            transcript = f"{SUMMARY_PREFIX}{previous}\n\n{self._transcript(messages[-step:])}"
+        else:
+            transcript = self._transcript(messages)
+
+        try:
+            summary = await self._request_summary(transcript)
+        except Exception as err:
+            logger.warning("[max_turns_compaction] summary failed: %s", err)
+            return ""
+
+        await loop.run_in_executor(
+            None, partial(self.summaries.set, cache_key, summary, ttl=self.valves.summary_cache_ttl * 86400)
+        )
+        return summary
+
+    async def _request_summary(self, transcript: str) -> str:
+        async with httpx.AsyncClient(
+            base_url=self.valves.summary_base_url,
+            headers={"Authorization": f"Bearer {self.valves.summary_api_key}"},
+            trust_env=True,
+            timeout=self.valves.summary_timeout,
+        ) as client:
+            response = await client.post(
+                "/chat/completions",
+                json={
+                    "model": self.valves.summary_model,
+                    "messages": [
+                        {"role": "system", "content": SUMMARY_PROMPT},
+                        {"role": "user", "content": transcript},
+                    ],
+                    "stream": False,
+                },
+            )
+            response.raise_for_status()
+            return response.json()["choices"][0]["message"]["content"].strip()
+
+    def _strip_images(self, message: dict) -> dict:
+        if not isinstance(message["content"], list):
+            return message
+        content = []
+        for item in message["content"]:
+            if item.get("type") == "image_url":
+                content.append({"type": "text", "text": IMAGE_PLACEHOLDER})
+                continue
+            content.append(item)
+        return {**message, "content": content}
+
+    def _transcript(self, messages: List[dict]) -> str:
+        lines = []
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, list):
+                content = "\n".join(item.get("text", IMAGE_PLACEHOLDER) for item in content)
+            lines.append(f"{message['role']}: {content}")
+        return "\n\n".join(lines)
+
+    def _hash(self, messages: List[dict]) -> str:
+        data = json.dumps([[m["role"], m["content"]] for m in messages], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
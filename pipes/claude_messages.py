@@ -2,25 +2,36 @@
 title: Claude Messages
 author: OVINC CN
 git_url: https://github.com/OVINC-CN/OpenWebUIPlugin.git
-version: 0.1.8
+version: 0.1.15
 licence: MIT
 """
 
+import asyncio
+import base64
+import hashlib
 import json
 import logging
+import threading
 import time
 import uuid
-from typing import AsyncIterable, Literal, Optional, Tuple
+from collections import OrderedDict
+from functools import partial
+from typing import AsyncIterable, Dict, Literal, Optional, Tuple
 
 import httpx
 from fastapi import Request
 from httpx import Response
+from open_webui.env import REDIS_SENTINEL_HOSTS, REDIS_SENTINEL_PORT, REDIS_URL
+from open_webui.utils.redis import get_redis_connection, get_sentinels_from_env
 from pydantic import BaseModel, Field
 from starlette.responses import StreamingResponse
 
 logger = logging.getLogger(__name__)
 logger.setLevel("INFO")
 
+FILES_API_BETA = "files-api-2025-04-14"
+DISCONNECT_CHECK_INTERVAL = 1
+
 
 class APIException(Exception):
     def __init__(self, status: int, content: str, response: Response):
@@ -42,6 +53,72 @@ class APIException(Exception):
         return "Unknown API error"
 
 
+class ClientDisconnectedError(Exception):
+    pass
+
+
+class StreamStalledError(Exception):
+    pass
+
+
+class FileIndex:
+    def __init__(self, prefix: str, max_items: int = 10000):
+        self.prefix = prefix
+        self.max_items = max_items
+        self._items: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = get_redis_connection(
+            redis_url=REDIS_URL,
+            redis_sentinels=get_sentinels_from_env(REDIS_SENTINEL_HOSTS, REDIS_SENTINEL_PORT),
+            decode_responses=True,
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        key = f"{self.prefix}:{key}"
+        # shared index
+        if self._redis is not None:
+            try:
+                return self._redis.get(key)
+            except Exception as err:
+                logger.warning("[FileIndex] redis get failed: %s", err)
+        # local index
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[1] < time.time():
+                self._items.pop(key, None)
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        key = f"{self.prefix}:{key}"
+        # shared index
+        if self._redis is not None:
+            try:
+                self._redis.set(key, value, ex=ttl)
+                return
+            except Exception as err:
+                logger.warning("[FileIndex] redis set failed: %s", err)
+        # local index
+        with self._lock:
+            self._items[key] = (value, time.time() + ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        key = f"{self.prefix}:{key}"
+        if self._redis is not None:
+            try:
+                self._redis.delete(key)
+            except Exception as err:
+                logger.warning("[FileIndex] redis delete failed: %s", err)
+        with self._lock:
+            self._items.pop(key, None)
+
+
 class Pipe:
     class Valves(BaseModel):
         base_url: str = Field(default="https://api.anthropic.com/v1", title="Base URL")
@@ -50,13 +127,44 @@ class Pipe:
             default="", title="透传参数", description="允许配置的参数，使用英文逗号分隔，例如 temperature"
         )
         timeout: int = Field(default=600, title="请求超时时间（秒）")
+        total_timeout: int = Field(
+            default=0, title="请求总超时时间（秒）", description="单次流式请求的最长时间，0 表示不限制", ge=0
+        )
+        connect_timeout: int = Field(default=10, title="连接超时时间（秒）", ge=1)
+        first_byte_timeout: int = Field(
+            default=600,
+            title="首字超时时间（秒）",
+            description="发出请求到收到第一段数据的最长等待时间，默认与请求超时一致，推理模型不宜调低",
+            ge=1,
+        )
+        idle_timeout: int = Field(
+            default=600,
+            title="流式空闲超时时间（秒）",
+            description="两段数据之间的最长间隔，超时后中止请求，默认与请求超时一致",
+            ge=1,
+        )
+        model_timeouts: str = Field(
+            default="",
+            title="模型超时配置",
+            description="使用英文逗号分隔多个模型，使用/分隔模型、首字超时和空闲超时，例如 claude-opus-4-6/300/120",
+        )
         proxy: Optional[str] = Field(default="", title="代理地址")
         models: str = Field(default="claude-sonnet-4-6", title="模型", description="使用英文逗号分隔多个模型")
+        enable_file_upload: bool = Field(
+            default=False, title="图片上传到文件接口", description="较大的图片只上传一次，后续轮次通过 file_id 引用"
+        )
+        file_upload_min_size: int = Field(default=64, title="上传图片最小大小 (KB)", ge=0)
+        file_cache_ttl: int = Field(default=30, title="文件缓存有效期 (天)", ge=1, le=30)
         beta_tools: str = Field(
             default="",
             title="Beta工具和请求头",
             description="使用英文逗号分隔多个工具，使用/分隔工具和请求头",
         )
+        abort_on_disconnect: bool = Field(
+            default=False,
+            title="客户端断开时中止请求",
+            description="OpenWebUI 在后台消费响应时请求会提前结束，确认部署方式后再开启",
+        )
 
     class UserValves(BaseModel):
         max_tokens: int = Field(default=64000, title="最大响应Token数")
@@ -69,6 +177,7 @@ class Pipe:
 
     def __init__(self):
         self.valves = self.Valves()
+        self.file_index = FileIndex(prefix="claude_messages:file")
 
     def pipes(self):
         return [{"id": model, "name": model} for model in self.valves.models.split(",") if model]
@@ -85,86 +194,271 @@ class Pipe:
             headers={"anthropic-version": "2023-06-01", "X-Api-Key": self.valves.api_key},
             proxy=self.valves.proxy or None,
             trust_env=True,
-            timeout=self.valves.timeout,
+            timeout=self._http_timeout(model),
         ) as client:
-            async with client.stream(**payload) as response:
-                if response.status_code != 200:
-                    text = ""
-                    async for line in response.aiter_lines():
-                        text += line  # pylint: disable=R1713
-                    logger.error("response invalid with %d: %s", response.status_code, text)
-                    raise APIException(status=response.status_code, content=text, response=response)
-                is_thinking = False
-                running_tool = ""
-                async for line in response.aiter_lines():
-                    line = line.strip()
-                    if not line:
-                        continue
-                    if line.startswith("event:") or not line.startswith("data:"):
-                        continue
-                    if line.startswith("data: "):
-                        line = line[6:]
-                    if isinstance(line, str):
-                        line = json.loads(line)
-                    match line.get("type"):
-                        case "content_block_start":
-                            if line["content_block"].get("type") == "thinking":
-                                is_thinking = True
-                            if line["content_block"].get("type") == "server_tool_use":
-                                running_tool = line["content_block"].get("name", "")
-                                data = {
-                                    "event": {
-                                        "type": "status",
-                                        "data": {
-                                            "description": f"{running_tool} running",
-                                            "done": False,
-                                        },
-                                    }
-                                }
-                                yield f"data: {json.dumps(data)}\n\n"
-                        case "content_block_stop":
-                            if is_thinking:
-                                is_thinking = False
-                            if running_tool:
-                                data = {
-                                    "event": {
-                                        "type": "status",
-                                        "data": {
-                                            "description": f"{running_tool} finished",
-                                            "done": True,
-                                        },
-                                    }
-                                }
-                                running_tool = ""
-                                yield f"data: {json.dumps(data)}\n\n"
-                        case "content_block_delta":
-                            delta = line["delta"]
-                            yield self._format_stream_data(
-                                model=model,
-                                reasoning_content=delta.get("thinking") or "",
-                                content=delta.get("text") or "",
-                            )
-                        case "message_delta":
-                            metadata = line.get("usage") or None
-                            if not metadata:
+            offloaded, file_ids = (
+                await self._offload_images(client, payload) if self.valves.enable_file_upload else (None, {})
+            )
+            for request_payload in [offloaded, payload] if offloaded else [payload]:
+                started = time.time()
+                async with client.stream(**request_payload) as response:
+                    if response.status_code != 200:
+                        text = ""
+                        async for line in response.aiter_lines():
+                            text += line  # pylint: disable=R1713
+                        logger.error("response invalid with %d: %s", response.status_code, text)
+                        # a referenced file may be gone, forget it and resend the images inline
+                        if request_payload is offloaded and self._is_file_error(response.status_code, text):
+                            await self._forget_files(file_ids, text)
+                            continue
+                        raise APIException(status=response.status_code, content=text, response=response)
+                    is_thinking = False
+                    running_tool = ""
+                    usage_metadata = {}
+                    output_chars = 0
+                    checked_at = time.time()
+                    try:
+                        async for line in self._watch_lines(response, model, started):
+                            if time.time() - checked_at >= DISCONNECT_CHECK_INTERVAL:
+                                checked_at = time.time()
+                                await self._check_disconnected(__request__)
+                            line = line.strip()
+                            if not line:
                                 continue
-                            usage = {
-                                "prompt_tokens": metadata.pop("input_tokens", 0),
-                                "completion_tokens": metadata.pop("output_tokens", 0),
-                                "prompt_tokens_details": {
-                                    "cached_tokens": metadata.pop("cache_read_input_tokens", 0),
-                                    "cached_tokens_write": metadata.pop("cache_creation_input_tokens", 0),
-                                },
-                                "metadata": metadata,
-                            }
-                            # claude rate for cache write
-                            rate = 1.25 if user_valves.cache_timeout == "5m" else 2.0
-                            usage["prompt_tokens"] += int(
-                                rate * usage["prompt_tokens_details"]["cached_tokens_write"]
-                                + usage["prompt_tokens_details"]["cached_tokens"]
-                            )
-                            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+                            if line.startswith("event:") or not line.startswith("data:"):
+                                continue
+                            if line.startswith("data: "):
+                                line = line[6:]
+                            if isinstance(line, str):
+                                line = json.loads(line)
+                            match line.get("type"):
+                                case "message_start":
+                                    usage_metadata = dict(line["message"].get("usage") or {})
+                                case "content_block_start":
+                                    if line["content_block"].get("type") == "thinking":
+                                        is_thinking = True
+                                    if line["content_block"].get("type") == "server_tool_use":
+                                        running_tool = line["content_block"].get("name", "")
+                                        data = {
+                                            "event": {
+                                                "type": "status",
+                                                "data": {
+                                                    "description": f"{running_tool} running",
+                                                    "done": False,
+                                                },
+                                            }
+                                        }
+                                        yield f"data: {json.dumps(data)}\n\n"
+                                case "content_block_stop":
+                                    if is_thinking:
+                                        is_thinking = False
+                                    if running_tool:
+                                        data = {
+                                            "event": {
+                                                "type": "status",
+                                                "data": {
+                                                    "description": f"{running_tool} finished",
+                                                    "done": True,
+                                                },
+                                            }
+                                        }
+                                        running_tool = ""
+                                        yield f"data: {json.dumps(data)}\n\n"
+                                case "content_block_delta":
+                                    delta = line["delta"]
+                                    reasoning_content = delta.get("thinking") or ""
+                                    content = delta.get("text") or ""
+                                    output_chars += (
+                                        len(reasoning_content) + len(content) + len(delta.get("partial_json") or "")
+                                    )
+                                    yield self._format_stream_data(
+                                        model=model,
+                                        reasoning_content=reasoning_content,
+                                        content=content,
+                                    )
+                                case "message_delta":
+                                    metadata = line.get("usage") or None
+                                    if not metadata:
+                                        continue
+                                    usage_metadata = {}
+                                    usage = self._format_usage(metadata, user_valves)
+                                    yield self._format_stream_data(model=model, usage=usage, if_finished=True)
+                    except ClientDisconnectedError:
+                        # leaving the stream context closes the upstream connection
+                        if usage_metadata:
+                            usage = self._partial_usage(usage_metadata, output_chars, user_valves)
+                            logger.info("client disconnected, abort %s with usage %s", model, json.dumps(usage))
                             yield self._format_stream_data(model=model, usage=usage, if_finished=True)
+                    except StreamStalledError as err:
+                        logger.warning("stream of %s stalled: %s", model, err)
+                        yield self._format_stalled(err)
+                        if usage_metadata:
+                            usage = self._partial_usage(usage_metadata, output_chars, user_valves)
+                            yield self._format_stream_data(model=model, usage=usage, if_finished=True)
+                    except (asyncio.CancelledError, GeneratorExit):
+                        # stopped from the ui, the upstream connection is closed while unwinding
+                        if usage_metadata:
+                            usage = self._partial_usage(usage_metadata, output_chars, user_valves)
+                            logger.info("generation stopped, abort %s with usage %s", model, json.dumps(usage))
+                        raise
+                break
+
+    async def _watch_lines(self, response: Response, model: str, started: float) -> AsyncIterable[str]:
+        # httpx only bounds single reads, abort when the first chunk, the next chunk or the whole response is late
+        first_byte_timeout, idle_timeout = self._stream_timeouts(model)
+        deadline = started + self.valves.total_timeout if self.valves.total_timeout > 0 else float("inf")
+        lines = response.aiter_lines()
+        wait_until, reason = started + first_byte_timeout, f"no response within {first_byte_timeout}s"
+        while True:
+            if deadline < wait_until:
+                wait_until, reason = deadline, f"response exceeded {self.valves.total_timeout}s"
+            try:
+                line = await asyncio.wait_for(anext(lines), timeout=max(wait_until - time.time(), 0))
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError as err:
+                raise StreamStalledError(reason) from err
+            yield line
+            wait_until, reason = time.time() + idle_timeout, f"no data for {idle_timeout}s"
+
+    def _stream_timeouts(self, model: str) -> Tuple[int, int]:
+        # thinking models may stay silent for a long time, so they get their own budgets
+        for item in self.valves.model_timeouts.split(","):
+            parts = [part.strip() for part in item.split("/")]
+            if len(parts) == 3 and parts[0] == model and parts[1].isdigit() and parts[2].isdigit():
+                return int(parts[1]), int(parts[2])
+        return self.valves.first_byte_timeout, self.valves.idle_timeout
+
+    def _http_timeout(self, model: str = "") -> httpx.Timeout:
+        # the request timeout still bounds every single read, unless a stream budget is longer
+        first_byte_timeout, idle_timeout = self._stream_timeouts(model)
+        return httpx.Timeout(
+            max(self.valves.timeout, first_byte_timeout, idle_timeout),
+            connect=self.valves.connect_timeout,
+            pool=self.valves.connect_timeout,
+        )
+
+    def _format_stalled(self, err: StreamStalledError) -> str:
+        data = {"event": {"type": "status", "data": {"description": f"{err}, request aborted", "done": True}}}
+        return f"data: {json.dumps(data)}\n\n"
+
+    async def _check_disconnected(self, __request__: Request) -> None:
+        if self.valves.abort_on_disconnect and await __request__.is_disconnected():
+            raise ClientDisconnectedError()
+
+    def _format_usage(self, metadata: dict, user_valves: UserValves) -> dict:
+        metadata = dict(metadata)
+        usage = {
+            "prompt_tokens": metadata.pop("input_tokens", 0),
+            "completion_tokens": metadata.pop("output_tokens", 0),
+            "prompt_tokens_details": {
+                "cached_tokens": metadata.pop("cache_read_input_tokens", 0),
+                "cached_tokens_write": metadata.pop("cache_creation_input_tokens", 0),
+            },
+            "metadata": metadata,
+        }
+        # claude rate for cache write
+        rate = 1.25 if user_valves.cache_timeout == "5m" else 2.0
+        usage["prompt_tokens"] += int(
+            rate * usage["prompt_tokens_details"]["cached_tokens_write"]
+            + usage["prompt_tokens_details"]["cached_tokens"]
+        )
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        return usage
+
+    def _partial_usage(self, usage_metadata: dict, output_chars: int, user_valves: UserValves) -> dict:
+        # output tokens are only counted in the final message_delta, estimate them from the streamed text
+        usage_metadata = {
+            **usage_metadata,
+            "output_tokens": max(usage_metadata.get("output_tokens", 0), (output_chars + 3) // 4),
+        }
+        usage = self._format_usage(usage_metadata, user_valves)
+        usage["metadata"].update({"partial": True, "estimated_completion_tokens": True})
+        return usage
+
+    async def _offload_images(self, client: httpx.AsyncClient, payload: dict) -> Tuple[Optional[dict], Dict[str, str]]:
+        images = [
+            item
+            for message in payload["json"]["messages"]
+            for item in message["content"]
+            if item.get("type") == "image"
+            and item["source"]["type"] == "base64"
+            and len(item["source"]["data"]) >= self.valves.file_upload_min_size * 1024
+        ]
+        if not images:
+            return None, {}
+        # upload new images once, reference every image by file id
+        sources = list({item["source"]["data"]: item["source"] for item in images}.values())
+        uploads = await asyncio.gather(*[self._upload_file(client, source) for source in sources])
+        uploads = {source["data"]: upload for source, upload in zip(sources, uploads) if upload[0]}
+        if not uploads:
+            return None, {}
+        # the inline payload is kept untouched as a fallback
+        messages = [
+            {
+                **message,
+                "content": [
+                    (
+                        {**item, "source": {"type": "file", "file_id": uploads[item["source"]["data"]][0]}}
+                        if item.get("type") == "image" and item["source"].get("data") in uploads
+                        else item
+                    )
+                    for item in message["content"]
+                ],
+            }
+            for message in payload["json"]["messages"]
+        ]
+        beta_headers = [i for i in payload.get("headers", {}).get("anthropic-beta", "").split(",") if i]
+        offloaded = {
+            **payload,
+            "json": {**payload["json"], "messages": messages},
+            "headers": {**payload.get("headers", {}), "anthropic-beta": ",".join(beta_headers + [FILES_API_BETA])},
+        }
+        return offloaded, dict(uploads.values())
+
+    async def _upload_file(self, client: httpx.AsyncClient, source: dict) -> Tuple[str, str]:
+        digest = hashlib.sha256(source["data"].encode()).hexdigest()
+        account = hashlib.sha256(f"{self.valves.base_url}:{self.valves.api_key}".encode()).hexdigest()[:16]
+        cache_key = f"{account}:{digest}"
+        loop = asyncio.get_running_loop()
+        file_id = await loop.run_in_executor(None, self.file_index.get, cache_key)
+        if file_id:
+            return file_id, cache_key
+        try:
+            response = await client.post(
+                "/files",
+                headers={"anthropic-beta": FILES_API_BETA},
+                files={
+                    "file": (
+                        f"{digest[:16]}.{source['media_type'].split('/')[-1]}",
+                        base64.b64decode(source["data"]),
+                        source["media_type"],
+                    )
+                },
+            )
+        except httpx.RequestError as err:
+            logger.warning("upload image failed: %s", err)
+            return "", cache_key
+        if response.status_code != 200:
+            logger.warning("upload image failed with %d: %s", response.status_code, response.text)
+            return "", cache_key
+        file_id = response.json()["id"]
+        await loop.run_in_executor(
+            None, partial(self.file_index.set, cache_key, file_id, ttl=self.valves.file_cache_ttl * 86400)
+        )
+        return file_id, cache_key
+
+    def _is_file_error(self, status_code: int, text: str) -> bool:
+        return 400 <= status_code < 500 and "file" in text.lower()
+
+    async def _forget_files(self, file_ids: Dict[str, str], text: str) -> None:
+        # drop the files named in the error, or every file of the request when none is named
+        cache_keys = [cache_key for file_id, cache_key in file_ids.items() if file_id in text] or list(
+            file_ids.values()
+        )
+        logger.warning("file reference rejected, resend %d image(s) inline", len(cache_keys))
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(None, self.file_index.delete, key) for key in cache_keys])
 
     async def _build_payload(self, body: dict, user_valves: UserValves, stream: bool = True) -> Tuple[str, dict]:
         model = body["model"].split(".", 1)[1]
@@ -180,26 +474,18 @@ class Pipe:
                     if item["type"] == "text":
                         content.append({"type": "text", "text": item["text"]})
                     elif item["type"] == "image_url":
-                        content.append(
-                            {
-                                "type": "image",
-                                "source": {
-                                    **(
-                                        {
-                                            "type": "url",
-                                            "url": item["image_url"]["url"],
-                                        }
-                                        if item["image_url"]["url"].startswith("http")
-                                        else {
-                                            # data:image/png;base64,xxx
-                                            "type": "base64",
-                                            "data": item["image_url"]["url"].split(",", 1)[1],
-                                            "media_type": (item["image_url"]["url"].split(";", 1)[0]).split(":", 1)[1],
-                                        }
-                                    )
-                                },
+                        image_url = item["image_url"]["url"]
+                        if image_url.startswith("http"):
+                            source = {"type": "url", "url": image_url}
+                        else:
+                            # data:image/png;base64,xxx, split once so the data is copied once
+                            header, data = image_url.split(",", 1)
+                            source = {
+                                "type": "base64",
+                                "data": data,
+                                "media_type": header.split(";", 1)[0].split(":", 1)[1],
                             }
-                        )
+                        content.append({"type": "image", "source": source})
                     else:
                         raise TypeError("Invalid message content type %s" % item["type"])
                 messages.append({"role": message["role"], "content": content})
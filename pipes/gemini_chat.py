@@ -3,25 +3,37 @@ title: Gemini Chat
 description: Text generation with Gemini
 author: OVINC CN
 git_url: https://github.com/OVINC-CN/OpenWebUIPlugin.git
-version: 0.1.2
+version: 0.1.8
 licence: MIT
 """
 
+import asyncio
+import base64
+import hashlib
 import json
 import logging
+import threading
 import time
 import uuid
-from typing import AsyncIterable, Literal, Optional, Tuple
+from collections import OrderedDict
+from datetime import datetime
+from functools import partial
+from typing import AsyncIterable, Dict, Literal, Optional, Tuple
 
 import httpx
 from fastapi import Request
 from httpx import Response
+from open_webui.env import REDIS_SENTINEL_HOSTS, REDIS_SENTINEL_PORT, REDIS_URL
+from open_webui.utils.redis import get_redis_connection, get_sentinels_from_env
 from pydantic import BaseModel, Field
 from starlette.responses import StreamingResponse
 
 logger = logging.getLogger(__name__)
 logger.setLevel("INFO")
 
+GEMINI_FILE_TTL = 48 * 3600
+DISCONNECT_CHECK_INTERVAL = 1
+
 
 class APIException(Exception):
     def __init__(self, status: int, content: str, response: Response):
@@ -43,6 +55,72 @@ class APIException(Exception):
         return "Unknown API error"
 
 
+class ClientDisconnectedError(Exception):
+    pass
+
+
+class StreamStalledError(Exception):
+    pass
+
+
+class FileIndex:
+    def __init__(self, prefix: str, max_items: int = 10000):
+        self.prefix = prefix
+        self.max_items = max_items
+        self._items: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = get_redis_connection(
+            redis_url=REDIS_URL,
+            redis_sentinels=get_sentinels_from_env(REDIS_SENTINEL_HOSTS, REDIS_SENTINEL_PORT),
+            decode_responses=True,
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        key = f"{self.prefix}:{key}"
+        # shared index
+        if self._redis is not None:
+            try:
+                return self._redis.get(key)
+            except Exception as err:
+                logger.warning("[FileIndex] redis get failed: %s", err)
+        # local index
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[1] < time.time():
+                self._items.pop(key, None)
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        key = f"{self.prefix}:{key}"
+        # shared index
+        if self._redis is not None:
+            try:
+                self._redis.set(key, value, ex=ttl)
+                return
+            except Exception as err:
+                logger.warning("[FileIndex] redis set failed: %s", err)
+        # local index
+        with self._lock:
+            self._items[key] = (value, time.time() + ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        key = f"{self.prefix}:{key}"
+        if self._redis is not None:
+            try:
+                self._redis.delete(key)
+            except Exception as err:
+                logger.warning("[FileIndex] redis delete failed: %s", err)
+        with self._lock:
+            self._items.pop(key, None)
+
+
 class Pipe:
     class Valves(BaseModel):
         base_url: str = Field(
@@ -55,8 +133,41 @@ class Pipe:
         )
         enable_reasoning: bool = Field(default=True, title="展示思考内容")
         timeout: int = Field(default=600, title="请求超时时间 (秒)")
+        total_timeout: int = Field(
+            default=0, title="请求总超时时间 (秒)", description="单次流式请求的最长时间，0 表示不限制", ge=0
+        )
+        connect_timeout: int = Field(default=10, title="连接超时时间 (秒)", ge=1)
+        first_byte_timeout: int = Field(
+            default=600,
+            title="首字超时时间 (秒)",
+            description="发出请求到收到第一段数据的最长等待时间，默认与请求超时一致，推理模型不宜调低",
+            ge=1,
+        )
+        idle_timeout: int = Field(
+            default=600,
+            title="流式空闲超时时间 (秒)",
+            description="两段数据之间的最长间隔，超时后中止请求，默认与请求超时一致",
+            ge=1,
+        )
+        model_timeouts: str = Field(
+            default="",
+            title="模型超时配置",
+            description="使用英文逗号分隔多个模型，使用/分隔模型、首字超时和空闲超时，例如 gemini-2.5-pro/600/120",
+        )
         proxy: Optional[str] = Field(default=None, title="代理地址")
         models: str = Field(default="gemini-2.5-pro", title="模型", description="使用英文逗号分隔多个模型")
+        enable_file_upload: bool = Field(
+            default=False, title="大文件上传到文件接口", description="较大的图片通过 Files API 上传一次，48 小时内复用"
+        )
+        file_upload_min_size: int = Field(default=256, title="上传文件最小大小 (KB)", ge=0)
+        upload_url: str = Field(
+            default="https://generativelanguage.googleapis.com/upload/v1beta/files", title="上传地址"
+        )
+        abort_on_disconnect: bool = Field(
+            default=False,
+            title="客户端断开时中止请求",
+            description="OpenWebUI 在后台消费响应时请求会提前结束，确认部署方式后再开启",
+        )
 
     class UserValves(BaseModel):
         reasoning_effort: Literal["low", "medium", "high"] = Field(
@@ -65,6 +176,7 @@ class Pipe:
 
     def __init__(self):
         self.valves = self.Valves()
+        self.file_registry = FileIndex(prefix="gemini_chat:file")
 
     def pipes(self):
         return [{"id": model, "name": model} for model in self.valves.models.split(",")]
@@ -84,104 +196,287 @@ class Pipe:
             headers={"x-goog-api-key": self.valves.api_key},
             proxy=self.valves.proxy or None,
             trust_env=True,
-            timeout=self.valves.timeout,
+            timeout=self._http_timeout(model),
         ) as client:
-            async with client.stream(**payload) as response:
-                if response.status_code != 200:
-                    text = ""
-                    async for line in response.aiter_lines():
-                        text += line  # pylint: disable=R1713
-                    logger.error("response invalid with %d: %s", response.status_code, text)
-                    raise APIException(response.status_code, text, response)
-                # parse resp
-                is_thinking = self.valves.enable_reasoning
-                async for line in response.aiter_lines():
-                    # format stream data
-                    line = line.strip()
-                    if not line:
-                        continue
-                    if line.startswith("event:") or not line.startswith("data:"):
-                        continue
-                    if line.startswith("data: "):
-                        line = line[6:]
-                    if isinstance(line, str):
-                        line = json.loads(line)
-                    for item in line["candidates"]:
-                        content = item.get("content", {})
-                        if not content:
-                            yield self._format_data(
-                                is_stream=True,
-                                model=model,
-                                content=item.get("finishReason", ""),
-                            )
-                            continue
-                        parts = content.get("parts", [])
-                        if not parts:
-                            yield self._format_data(
-                                is_stream=True,
-                                model=model,
-                                content=item.get("finishReason", ""),
-                            )
+            offloaded, file_uris = (
+                await self._offload_media(client, payload) if self.valves.enable_file_upload else (None, {})
+            )
+            for request_payload in [offloaded, payload] if offloaded else [payload]:
+                started = time.time()
+                async with client.stream(**request_payload) as response:
+                    if response.status_code != 200:
+                        text = ""
+                        async for line in response.aiter_lines():
+                            text += line  # pylint: disable=R1713
+                        logger.error("response invalid with %d: %s", response.status_code, text)
+                        # an uploaded file may have expired, forget it and resend the media inline
+                        if request_payload is offloaded and self._is_file_error(response.status_code, text):
+                            await self._forget_files(file_uris, text)
                             continue
-                        for part in parts:
-                            # thinking content
-                            if part.get("thought", False):
-                                if is_thinking:
-                                    yield self._format_data(is_stream=True, model=model, reasoning_content=part["text"])
-                            # no thinking content
-                            else:
-                                # stop thinking
-                                if is_thinking and part.get("text"):
-                                    is_thinking = False
-                                # text content
-                                if part.get("text"):
-                                    yield self._format_data(is_stream=True, model=model, content=part["text"])
-                                # code content
-                                if part.get("executableCode"):
-                                    data = {
-                                        "event": {
-                                            "type": "status",
-                                            "data": {
-                                                "description": (
-                                                    f"executableCode {part['executableCode'].get('language', '')}"
-                                                ),
-                                                "done": False,
-                                            },
-                                        }
-                                    }
-                                    yield f"data: {json.dumps(data)}\n\n"
-                                if part.get("codeExecutionResult"):
-                                    data = {
-                                        "event": {
-                                            "type": "status",
-                                            "data": {
-                                                "description": (
-                                                    "codeExecutionResult "
-                                                    f"{part['codeExecutionResult'].get('outcome', '')}"
-                                                ),
-                                                "done": True,
-                                            },
-                                        }
-                                    }
-                                    yield f"data: {json.dumps(data)}\n\n"
-                    # format usage data
-                    usage_metadata = line.get("usageMetadata", None) or {}
-                    usage = {
-                        "prompt_tokens": usage_metadata.pop("promptTokenCount", 0) if usage_metadata else 0,
-                        "completion_tokens": usage_metadata.pop("candidatesTokenCount", 0) if usage_metadata else 0,
-                        "total_tokens": usage_metadata.pop("totalTokenCount", 0) if usage_metadata else 0,
-                        "prompt_tokens_details": {
-                            "cached_tokens": (usage_metadata.get("cachedContentTokenCount", 0) if usage_metadata else 0)
-                        },
-                        "metadata": usage_metadata or {},
-                    }
-                    if usage_metadata and "toolUsePromptTokenCount" in usage_metadata:
-                        usage["prompt_tokens"] += usage_metadata["toolUsePromptTokenCount"]
-                    if usage_metadata and "thoughtsTokenCount" in usage_metadata:
-                        usage["completion_tokens"] += usage_metadata["thoughtsTokenCount"]
-                    if usage["prompt_tokens"] + usage["completion_tokens"] != usage["total_tokens"]:
-                        usage["completion_tokens"] = usage["total_tokens"] - usage["prompt_tokens"]
-                    yield self._format_data(is_stream=True, model=model, usage=usage)
+                        raise APIException(response.status_code, text, response)
+                    # parse resp
+                    is_thinking = self.valves.enable_reasoning
+                    usage = None
+                    checked_at = time.time()
+                    try:
+                        async for line in self._watch_lines(response, model, started):
+                            if time.time() - checked_at >= DISCONNECT_CHECK_INTERVAL:
+                                checked_at = time.time()
+                                await self._check_disconnected(__request__)
+                            # format stream data
+                            line = line.strip()
+                            if not line:
+                                continue
+                            if line.startswith("event:") or not line.startswith("data:"):
+                                continue
+                            if line.startswith("data: "):
+                                line = line[6:]
+                            if isinstance(line, str):
+                                line = json.loads(line)
+                            for item in line["candidates"]:
+                                content = item.get("content", {})
+                                if not content:
+                                    yield self._format_data(
+                                        is_stream=True,
+                                        model=model,
+                                        content=item.get("finishReason", ""),
+                                    )
+                                    continue
+                                parts = content.get("parts", [])
+                                if not parts:
+                                    yield self._format_data(
+                                        is_stream=True,
+                                        model=model,
+                                        content=item.get("finishReason", ""),
+                                    )
+                                    continue
+                                for part in parts:
+                                    # thinking content
+                                    if part.get("thought", False):
+                                        if is_thinking:
+                                            yield self._format_data(
+                                                is_stream=True, model=model, reasoning_content=part["text"]
+                                            )
+                                    # no thinking content
+                                    else:
+                                        # stop thinking
+                                        if is_thinking and part.get("text"):
+                                            is_thinking = False
+                                        # text content
+                                        if part.get("text"):
+                                            yield self._format_data(is_stream=True, model=model, content=part["text"])
+                                        # code content
+                                        if part.get("executableCode"):
+                                            data = {
+                                                "event": {
+                                                    "type": "status",
+                                                    "data": {
+                                                        "description": (
+                                                            "executableCode "
+                                                            f"{part['executableCode'].get('language', '')}"
+                                                        ),
+                                                        "done": False,
+                                                    },
+                                                }
+                                            }
+                                            yield f"data: {json.dumps(data)}\n\n"
+                                        if part.get("codeExecutionResult"):
+                                            data = {
+                                                "event": {
+                                                    "type": "status",
+                                                    "data": {
+                                                        "description": (
+                                                            "codeExecutionResult "
+                                                            f"{part['codeExecutionResult'].get('outcome', '')}"
+                                                        ),
+                                                        "done": True,
+                                                    },
+                                                }
+                                            }
+                                            yield f"data: {json.dumps(data)}\n\n"
+                            # format usage data
+                            usage_metadata = line.get("usageMetadata", None) or {}
+                            usage = {
+                                "prompt_tokens": usage_metadata.pop("promptTokenCount", 0) if usage_metadata else 0,
+                                "completion_tokens": (
+                                    usage_metadata.pop("candidatesTokenCount", 0) if usage_metadata else 0
+                                ),
+                                "total_tokens": usage_metadata.pop("totalTokenCount", 0) if usage_metadata else 0,
+                                "prompt_tokens_details": {
+                                    "cached_tokens": (
+                                        usage_metadata.get("cachedContentTokenCount", 0) if usage_metadata else 0
+                                    )
+                                },
+                                "metadata": usage_metadata or {},
+                            }
+                            if usage_metadata and "toolUsePromptTokenCount" in usage_metadata:
+                                usage["prompt_tokens"] += usage_metadata["toolUsePromptTokenCount"]
+                            if usage_metadata and "thoughtsTokenCount" in usage_metadata:
+                                usage["completion_tokens"] += usage_metadata["thoughtsTokenCount"]
+                            if usage["prompt_tokens"] + usage["completion_tokens"] != usage["total_tokens"]:
+                                usage["completion_tokens"] = usage["total_tokens"] - usage["prompt_tokens"]
+                            yield self._format_data(is_stream=True, model=model, usage=usage)
+                    except ClientDisconnectedError:
+                        # leaving the stream context closes the upstream connection
+                        if usage:
+                            usage["metadata"]["partial"] = True
+                            logger.info("client disconnected, abort %s with usage %s", model, json.dumps(usage))
+                            yield self._format_data(is_stream=True, model=model, usage=usage)
+                    except StreamStalledError as err:
+                        logger.warning("stream of %s stalled: %s", model, err)
+                        yield self._format_stalled(err)
+                        if usage:
+                            usage["metadata"]["partial"] = True
+                            yield self._format_data(is_stream=True, model=model, usage=usage)
+                    except (asyncio.CancelledError, GeneratorExit):
+                        # stopped from the ui, the upstream connection is closed while unwinding
+                        if usage:
+                            logger.info("generation stopped, abort %s with usage %s", model, json.dumps(usage))
+                        raise
+                break
+
+    async def _watch_lines(self, response: Response, model: str, started: float) -> AsyncIterable[str]:
+        # httpx only bounds single reads, abort when the first chunk, the next chunk or the whole response is late
+        first_byte_timeout, idle_timeout = self._stream_timeouts(model)
+        deadline = started + self.valves.total_timeout if self.valves.total_timeout > 0 else float("inf")
+        lines = response.aiter_lines()
+        wait_until, reason = started + first_byte_timeout, f"no response within {first_byte_timeout}s"
+        while True:
+            if deadline < wait_until:
+                wait_until, reason = deadline, f"response exceeded {self.valves.total_timeout}s"
+            try:
+                line = await asyncio.wait_for(anext(lines), timeout=max(wait_until - time.time(), 0))
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError as err:
+                raise StreamStalledError(reason) from err
+            yield line
+            wait_until, reason = time.time() + idle_timeout, f"no data for {idle_timeout}s"
+
+    def _stream_timeouts(self, model: str) -> Tuple[int, int]:
+        # thinking models may stay silent for a long time, so they get their own budgets
+        for item in self.valves.model_timeouts.split(","):
+            parts = [part.strip() for part in item.split("/")]
+            if len(parts) == 3 and parts[0] == model and parts[1].isdigit() and parts[2].isdigit():
+                return int(parts[1]), int(parts[2])
+        return self.valves.first_byte_timeout, self.valves.idle_timeout
+
+    def _http_timeout(self, model: str = "") -> httpx.Timeout:
+        # the request timeout still bounds every single read, unless a stream budget is longer
+        first_byte_timeout, idle_timeout = self._stream_timeouts(model)
+        return httpx.Timeout(
+            max(self.valves.timeout, first_byte_timeout, idle_timeout),
+            connect=self.valves.connect_timeout,
+            pool=self.valves.connect_timeout,
+        )
+
+    def _format_stalled(self, err: StreamStalledError) -> str:
+        data = {"event": {"type": "status", "data": {"description": f"{err}, request aborted", "done": True}}}
+        return f"data: {json.dumps(data)}\n\n"
+
+    async def _check_disconnected(self, __request__: Request) -> None:
+        if self.valves.abort_on_disconnect and await __request__.is_disconnected():
+            raise ClientDisconnectedError()
+
+    async def _offload_media(self, client: httpx.AsyncClient, payload: dict) -> Tuple[Optional[dict], Dict[str, str]]:
+        media = {
+            part["inline_data"]["data"]: part["inline_data"]
+            for content in payload["json"]["contents"]
+            for part in content["parts"]
+            if "inline_data" in part and len(part["inline_data"]["data"]) >= self.valves.file_upload_min_size * 1024
+        }
+        if not media:
+            return None, {}
+        # upload new media once, reference every part by file uri
+        uploads = await asyncio.gather(
+            *[self._upload_media(client, item["data"], item["mime_type"]) for item in media.values()]
+        )
+        uploads = {data: upload for data, upload in zip(media, uploads) if upload[0]}
+        if not uploads:
+            return None, {}
+        # the inline payload is kept untouched as a fallback
+        contents = [
+            {
+                **content,
+                "parts": [
+                    (
+                        {
+                            **{key: val for key, val in part.items() if key != "inline_data"},
+                            "file_data": {
+                                "mime_type": part["inline_data"]["mime_type"],
+                                "file_uri": uploads[part["inline_data"]["data"]][0],
+                            },
+                        }
+                        if "inline_data" in part and part["inline_data"]["data"] in uploads
+                        else part
+                    )
+                    for part in content["parts"]
+                ],
+            }
+            for content in payload["json"]["contents"]
+        ]
+        return {**payload, "json": {**payload["json"], "contents": contents}}, dict(uploads.values())
+
+    async def _upload_media(self, client: httpx.AsyncClient, data: str, mime_type: str) -> Tuple[str, str]:
+        # hashing, decoding and the registry lookups stay off the event loop
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(None, self._media_digest, data)
+        account = hashlib.sha256(f"{self.valves.upload_url}:{self.valves.api_key}".encode()).hexdigest()[:16]
+        registry_key = f"{account}:{digest}"
+        file_uri = await loop.run_in_executor(None, self.file_registry.get, registry_key)
+        if file_uri:
+            return file_uri, registry_key
+        media = await loop.run_in_executor(None, base64.b64decode, data)
+        try:
+            # resumable upload: start a session, then send the bytes and finalize
+            response = await client.post(
+                self.valves.upload_url,
+                headers={
+                    "X-Goog-Upload-Protocol": "resumable",
+                    "X-Goog-Upload-Command": "start",
+                    "X-Goog-Upload-Header-Content-Length": str(len(media)),
+                    "X-Goog-Upload-Header-Content-Type": mime_type,
+                },
+                json={"file": {"display_name": digest[:16]}},
+            )
+            if response.status_code == 200:
+                response = await client.post(
+                    response.headers["x-goog-upload-url"],
+                    headers={"X-Goog-Upload-Offset": "0", "X-Goog-Upload-Command": "upload, finalize"},
+                    content=media,
+                )
+        except (httpx.RequestError, KeyError) as err:
+            logger.warning("upload media failed: %s", err)
+            return "", registry_key
+        if response.status_code != 200:
+            logger.warning("upload media failed with %d: %s", response.status_code, response.text)
+            return "", registry_key
+        file = response.json()["file"]
+        # files expire after 48 hours, forget them an hour earlier
+        ttl = GEMINI_FILE_TTL
+        try:
+            ttl = int(datetime.fromisoformat(file["expirationTime"].replace("Z", "+00:00")).timestamp() - time.time())
+        except (KeyError, ValueError):
+            pass
+        await loop.run_in_executor(
+            None, partial(self.file_registry.set, registry_key, file["uri"], ttl=max(ttl - 3600, 60))
+        )
+        return file["uri"], registry_key
+
+    def _media_digest(self, data: str) -> str:
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def _is_file_error(self, status_code: int, text: str) -> bool:
+        return 400 <= status_code < 500 and "file" in text.lower()
+
+    async def _forget_files(self, file_uris: Dict[str, str], text: str) -> None:
+        # drop the files named in the error, or every file of the request when none is named
+        registry_keys = [
+            registry_key for file_uri, registry_key in file_uris.items() if file_uri.rsplit("/", 1)[-1] in text
+        ] or list(file_uris.values())
+        logger.warning("file reference rejected, resend %d media inline", len(registry_keys))
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(None, self.file_registry.delete, key) for key in registry_keys])
 
     async def _build_payload(self, body: dict, user_valves: UserValves) -> Tuple[str, dict]:
         # payload
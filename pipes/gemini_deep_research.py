@@ -3,22 +3,39 @@ title: Gemini Deep Research
 description: Deep Research with Gemini
 author: OVINC CN
 git_url: https://github.com/OVINC-CN/OpenWebUIPlugin.git
-version: 0.0.4
+version: 0.0.15
 licence: MIT
 """
 
 import asyncio
+import base64
+import hashlib
+import io
 import json
 import logging
+import random
+import threading
 import time
 import uuid
-from typing import AsyncIterable, Optional, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import AsyncIterable, Callable, Dict, List, Optional, Set, Tuple
 
 import httpx
-from fastapi import Request
+from fastapi import BackgroundTasks, Request, UploadFile
 from httpx import Response
-from open_webui.env import GLOBAL_LOG_LEVEL
+from open_webui.env import (
+    GLOBAL_LOG_LEVEL,
+    REDIS_SENTINEL_HOSTS,
+    REDIS_SENTINEL_PORT,
+    REDIS_URL,
+)
+from open_webui.models.users import UserModel, Users
+from open_webui.routers.files import upload_file
+from open_webui.utils.redis import get_redis_connection, get_sentinels_from_env
 from pydantic import BaseModel, Field
+from starlette.datastructures import Headers
 from starlette.responses import StreamingResponse
 
 logger = logging.getLogger(__name__)
@@ -26,6 +43,8 @@ logger.setLevel(GLOBAL_LOG_LEVEL)
 
 INTERACTION_ID_LINE_PREFIX = "[](http://interaction.gemini.local/"
 INTERACTION_ID_LINE_SUFFIX = ")"
+UPLOAD_MAX_WORKERS = 4
+QUEUE_CHECK_INTERVAL = 5
 
 
 class APIException(Exception):
@@ -48,6 +67,212 @@ class APIException(Exception):
         return "Unknown API error"
 
 
+class StreamUnavailableError(Exception):
+    pass
+
+
+class ClientDisconnectedError(Exception):
+    pass
+
+
+class TaskStore:
+    def __init__(self, prefix: str, max_items: int = 1000):
+        self.prefix = prefix
+        self.max_items = max_items
+        self._items: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = get_redis_connection(
+            redis_url=REDIS_URL,
+            redis_sentinels=get_sentinels_from_env(REDIS_SENTINEL_HOSTS, REDIS_SENTINEL_PORT),
+            decode_responses=True,
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        key = f"{self.prefix}:{key}"
+        # shared store
+        if self._redis is not None:
+            try:
+                return self._redis.get(key)
+            except Exception as err:
+                logger.warning("[TaskStore] redis get failed: %s", err)
+        # local store
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[1] < time.time():
+                self._items.pop(key, None)
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        key = f"{self.prefix}:{key}"
+        # shared store
+        if self._redis is not None:
+            try:
+                self._redis.set(key, value, ex=ttl)
+                return
+            except Exception as err:
+                logger.warning("[TaskStore] redis set failed: %s", err)
+        # local store
+        with self._lock:
+            self._items[key] = (value, time.time() + ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        key = f"{self.prefix}:{key}"
+        if self._redis is not None:
+            try:
+                self._redis.delete(key)
+            except Exception as err:
+                logger.warning("[TaskStore] redis delete failed: %s", err)
+        with self._lock:
+            self._items.pop(key, None)
+
+    def incr(self, key: str, amount: int = 1) -> None:
+        key = f"{self.prefix}:{key}"
+        if self._redis is not None:
+            try:
+                self._redis.incrby(key, amount)
+                return
+            except Exception as err:
+                logger.warning("[TaskStore] redis incr failed: %s", err)
+        with self._lock:
+            value = int(self._items.get(key, ("0", 0))[0]) + amount
+            self._items[key] = (str(value), float("inf"))
+            self._items.move_to_end(key)
+
+
+class TaskScheduler:
+    def __init__(self):
+        self.max_active = 0
+        self.max_user_active = 0
+        self._queue: List[dict] = []
+        self._active: Dict[str, int] = {}
+
+    def enqueue(self, user_id: str, force: bool = False) -> dict:
+        ticket = {"user_id": user_id, "granted": False, "event": asyncio.Event()}
+        # already running upstream, never queue it again
+        if force:
+            self._grant(ticket)
+            return ticket
+        self._queue.append(ticket)
+        self._dispatch()
+        return ticket
+
+    def position(self, ticket: dict) -> int:
+        for index, item in enumerate(self._queue):
+            if item is ticket:
+                return index + 1
+        return 0
+
+    async def wait(self, ticket: dict, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(ticket["event"].wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return
+        ticket["event"].clear()
+
+    def release(self, ticket: dict) -> None:
+        if ticket["granted"]:
+            ticket["granted"] = False
+            self._active[ticket["user_id"]] -= 1
+            if self._active[ticket["user_id"]] <= 0:
+                self._active.pop(ticket["user_id"])
+        else:
+            self._queue = [item for item in self._queue if item is not ticket]
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        total = sum(self._active.values())
+        # fifo, skipping users that already hold their share
+        for ticket in list(self._queue):
+            if self.max_active and total >= self.max_active:
+                break
+            if self.max_user_active and self._active.get(ticket["user_id"], 0) >= self.max_user_active:
+                continue
+            self._queue.remove(ticket)
+            self._grant(ticket)
+            total += 1
+        # wake waiters so they can report their new position
+        for ticket in self._queue:
+            ticket["event"].set()
+
+    def _grant(self, ticket: dict) -> None:
+        ticket["granted"] = True
+        self._active[ticket["user_id"]] = self._active.get(ticket["user_id"], 0) + 1
+        ticket["event"].set()
+
+
+class InteractionPoller:
+    def __init__(self):
+        self._entries: Dict[str, dict] = {}
+        self._runner: Optional[asyncio.Task] = None
+
+    def register(
+        self, url: str, get_client: Callable[[], httpx.AsyncClient], min_interval: int, max_interval: int
+    ) -> Tuple[str, asyncio.Queue]:
+        key = uuid.uuid4().hex
+        queue = asyncio.Queue()
+        self._entries[key] = {
+            "url": url,
+            "queue": queue,
+            "get_client": get_client,
+            "min_interval": min_interval,
+            "max_interval": max_interval,
+            "interval": min_interval,
+            "next_at": time.time() + min_interval * random.uniform(0.8, 1.2),
+            "etag": "",
+            "digest": "",
+            "request": None,
+        }
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self._run())
+        return key, queue
+
+    def unregister(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    async def _run(self) -> None:
+        # one loop for every active interaction in this worker
+        while self._entries:
+            now = time.time()
+            for entry in list(self._entries.values()):
+                if entry["next_at"] <= now and entry["request"] is None:
+                    entry["request"] = asyncio.create_task(self._poll(entry))
+            # entries with a request in flight are rescheduled when it finishes
+            next_at = min(
+                (entry["next_at"] for entry in self._entries.values() if entry["request"] is None), default=now + 1
+            )
+            await asyncio.sleep(min(max(next_at - time.time(), 0.1), 1))
+
+    async def _poll(self, entry: dict) -> None:
+        changed = False
+        try:
+            response = await entry["get_client"]().get(
+                entry["url"], headers={"If-None-Match": entry["etag"]} if entry["etag"] else None
+            )
+            if response.status_code == 200:
+                entry["etag"] = response.headers.get("etag", "")
+                digest = hashlib.sha256(response.content).hexdigest()
+                changed = digest != entry["digest"]
+                entry["digest"] = digest
+            elif response.status_code != 304:
+                # let the consumer surface the error
+                changed = True
+            if changed:
+                entry["queue"].put_nowait(response)
+        except Exception as err:
+            logger.error("[GeminiDeepResearchPipe] request error: %s", err)
+        # back off while nothing changes, with jitter so tasks spread out
+        entry["interval"] = entry["min_interval"] if changed else min(entry["interval"] * 2, entry["max_interval"])
+        entry["next_at"] = time.time() + entry["interval"] * random.uniform(0.8, 1.2)
+        entry["request"] = None
+
+
 class Pipe:
     class Valves(BaseModel):
         base_url: str = Field(
@@ -61,8 +286,34 @@ class Pipe:
             description="允许配置的参数，使用英文逗号分隔，例如 temperature",
         )
         timeout: int = Field(default=300, title="请求超时时间 (秒)")
+        connect_timeout: int = Field(default=10, title="连接超时时间 (秒)", ge=1)
         task_timeout: int = Field(default=600, title="任务超时时间 (秒)")
         check_interval: int = Field(default=3, title="任务状态检查间隔 (秒)")
+        max_check_interval: int = Field(
+            default=30, title="任务状态最大检查间隔 (秒)", description="状态无变化时检查间隔逐步增加到该值"
+        )
+        enable_stream: bool = Field(default=True, title="流式获取任务结果", description="不可用时自动回退到轮询")
+        max_active_tasks: int = Field(
+            default=10,
+            title="单进程最大并发任务数",
+            description="每个 worker 单独计数，总上限为该值乘以 worker 数量，0 表示不限制",
+            ge=0,
+        )
+        max_user_tasks: int = Field(
+            default=2,
+            title="单进程单用户最大并发任务数",
+            description="每个 worker 单独计数，0 表示不限制",
+            ge=0,
+        )
+        queue_timeout: int = Field(
+            default=600, title="排队超时时间 (秒)", description="超时仍未开始的任务直接报错，0 表示不限制", ge=0
+        )
+        cancel_on_disconnect: bool = Field(
+            default=False,
+            title="客户端断开时取消任务",
+            description="同时放弃仍在排队的请求；OpenWebUI 在后台消费响应时请求会提前结束，确认部署方式后再开启",
+        )
+        stop_command: str = Field(default="/stop", title="停止命令", description="在对话中发送该命令取消正在运行的任务")
         proxy: Optional[str] = Field(default=None, title="代理地址")
         agent: str = Field(
             default="deep-research-pro-preview-12-2025",
@@ -72,6 +323,17 @@ class Pipe:
 
     def __init__(self):
         self.valves = self.Valves()
+        self.task_store = TaskStore(prefix="gemini_deep_research:task")
+        self.stats_store = TaskStore(prefix="gemini_deep_research:stats")
+        self.scheduler = TaskScheduler()
+        self.cancel_requests: Set[asyncio.Task] = set()
+        self.upload_executor = ThreadPoolExecutor(
+            max_workers=UPLOAD_MAX_WORKERS, thread_name_prefix="gemini-deep-research-upload"
+        )
+        self.poller = InteractionPoller()
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_config: Optional[tuple] = None
+        self._closing_clients: Set[asyncio.Task] = set()
 
     def pipes(self):
         return [{"id": model, "name": model} for model in self.valves.agent.split(",")]
@@ -81,19 +343,62 @@ class Pipe:
         body: dict,
         __user__: dict,
         __request__: Request,
+        __metadata__: Optional[dict] = None,
     ) -> StreamingResponse:
-        return StreamingResponse(self._pipe(body=body, __user__=__user__, __request__=__request__))
+        return StreamingResponse(
+            self._pipe(body=body, __user__=__user__, __request__=__request__, __metadata__=__metadata__ or {})
+        )
 
-    async def _pipe(self, body: dict, __user__: dict, __request__: Request) -> AsyncIterable:
+    async def _pipe(self, body: dict, __user__: dict, __request__: Request, __metadata__: dict) -> AsyncIterable:
         model, payload = await self._build_payload(body=body)
-        last_status = {"last_status": ""}
+        # explicit stop
+        if self._is_stop_command(body):
+            interaction_id = payload["json"].get("previous_interaction_id", "")
+            cancelled = interaction_id and await self._cancel_interaction(interaction_id, reason="command")
+            content = "Deep research stopped." if cancelled else "No running deep research to stop."
+            yield self._format_data(is_stream=True, model=model, content=content)
+            return
+        task_key = self._task_key(__user__=__user__, __metadata__=__metadata__, payload=payload)
+        task = self._resume_task(task_key, __metadata__.get("message_id", ""))
+        # wait for a slot
+        self.scheduler.max_active = self.valves.max_active_tasks
+        self.scheduler.max_user_active = self.valves.max_user_tasks
+        ticket = self.scheduler.enqueue(__user__["id"], force=task is not None)
+        queue_end = time.time() + self.valves.queue_timeout if self.valves.queue_timeout else float("inf")
+        try:
+            position = 0
+            while not ticket["granted"]:
+                if self.scheduler.position(ticket) != position:
+                    position = self.scheduler.position(ticket)
+                    yield self._format_event(description=f"Deep Research Queued: Position {position}", done=False)
+                # abandoned or stuck requests must not hold a place in the queue
+                try:
+                    await self._check_disconnected(__request__)
+                except ClientDisconnectedError:
+                    logger.info("[GeminiDeepResearchPipe] client disconnected while queued")
+                    return
+                if time.time() >= queue_end:
+                    raise TimeoutError("[GeminiDeepResearchPipe] queue timeout")
+                await self.scheduler.wait(ticket, timeout=min(queue_end - time.time(), QUEUE_CHECK_INTERVAL))
+            user = Users.get_user_by_id(__user__["id"])
+            async for item in self._run_task(__request__, user, model, payload, task_key, task, __metadata__):
+                yield item
+        finally:
+            self.scheduler.release(ticket)
+
+    async def _run_task(
+        self,
+        __request__: Request,
+        user: UserModel,
+        model: str,
+        payload: dict,
+        task_key: str,
+        task: Optional[dict],
+        __metadata__: dict,
+    ) -> AsyncIterable:
+        client = self._get_client()
         # call client
-        async with httpx.AsyncClient(
-            headers={"x-goog-api-key": self.valves.api_key},
-            proxy=self.valves.proxy or None,
-            trust_env=True,
-            timeout=self.valves.timeout,
-        ) as client:
+        if task is None:
             response = await client.request(**payload)
             # check resp
             if response.status_code != 200:
@@ -104,27 +409,258 @@ class Pipe:
                 )
                 raise APIException(response.status_code, response.text, response)
             resp_data = response.json()
-            yield self._format_data(
-                is_stream=True,
-                model=model,
-                content=f"{INTERACTION_ID_LINE_PREFIX}{resp_data['id']}{INTERACTION_ID_LINE_SUFFIX}\n\n",
-            )
-            yield self._task_status(last_status, resp_data)
+            task = {
+                "key": task_key,
+                "interaction_id": resp_data["id"],
+                "chat_id": __metadata__.get("chat_id", ""),
+                "message_id": __metadata__.get("message_id", ""),
+                "started_at": time.time(),
+                "last_status": "",
+                "last_event_id": "",
+                "emitted": {},
+                "images": {},
+            }
+            status = self._task_status(task, resp_data)
+        else:
+            logger.info("[GeminiDeepResearchPipe] resume interaction %s", task["interaction_id"])
+            status = self._format_status(task["last_status"])
+        yield self._format_data(
+            is_stream=True,
+            model=model,
+            content=f"{INTERACTION_ID_LINE_PREFIX}{task['interaction_id']}{INTERACTION_ID_LINE_SUFFIX}\n\n",
+        )
+        yield status
+        self._save_task(task)
         # loop for results
-        end_time = time.time() + self.valves.task_timeout
-        url = self.valves.base_url.rstrip("/") + f"/interactions/{resp_data['id']}"
-        async with httpx.AsyncClient(
-            headers={"x-goog-api-key": self.valves.api_key},
-            proxy=self.valves.proxy or None,
-            trust_env=True,
-            timeout=self.valves.timeout,
-        ) as client:
+        end_time = task["started_at"] + self.valves.task_timeout
+        url = self.valves.base_url.rstrip("/") + f"/interactions/{task['interaction_id']}"
+        try:
+            if self.valves.enable_stream:
+                try:
+                    async for item in self._stream_results(__request__, user, client, url, model, task, end_time):
+                        yield item
+                except StreamUnavailableError as err:
+                    logger.warning("[GeminiDeepResearchPipe] stream unavailable, fallback to polling: %s", err)
+            if not self._task_finished(task["last_status"]):
+                async for item in self._poll_results(__request__, user, url, model, task, end_time):
+                    yield item
+        except ClientDisconnectedError:
+            logger.info("[GeminiDeepResearchPipe] client disconnected from %s", task["interaction_id"])
+            self._schedule_cancel(task, reason="disconnect", end_time=end_time)
+            return
+        except (asyncio.CancelledError, GeneratorExit):
+            # stopped from the ui or a worker restart, which cannot be told apart here, so keep the task
+            # running upstream for a retry to resume, the stop command cancels it explicitly
+            self._save_task(task)
+            raise
+        except TimeoutError:
+            self._schedule_cancel(task, reason="timeout", end_time=end_time)
+            raise
+        except Exception:
+            self.task_store.delete(task_key)
+            raise
+        # delivered, nothing left to resume
+        self.task_store.delete(task_key)
+
+    def _schedule_cancel(self, task: dict, reason: str, end_time: float) -> None:
+        self.task_store.delete(task["key"])
+        # the generator may be closing, so do not await here
+        cancel_request = asyncio.create_task(
+            self._cancel_interaction(task["interaction_id"], reason=reason, remaining=end_time - time.time())
+        )
+        self.cancel_requests.add(cancel_request)
+        cancel_request.add_done_callback(self.cancel_requests.discard)
+
+    async def _cancel_interaction(self, interaction_id: str, reason: str, remaining: float = 0) -> bool:
+        url = self.valves.base_url.rstrip("/") + f"/interactions/{interaction_id}:cancel"
+        try:
+            response = await self._get_client().post(url)
+            cancelled = response.status_code == 200
+            if not cancelled:
+                logger.warning(
+                    "[GeminiDeepResearchPipe] cancel %s failed with %d: %s",
+                    interaction_id,
+                    response.status_code,
+                    response.text,
+                )
+        except Exception as err:
+            logger.warning("[GeminiDeepResearchPipe] cancel %s failed: %s", interaction_id, err)
+            cancelled = False
+        # cancel outcomes and the task time they gave back
+        logger.info(
+            "[GeminiDeepResearchPipe] cancel %s reason=%s cancelled=%s reclaimed=%ds",
+            interaction_id,
+            reason,
+            cancelled,
+            max(remaining, 0),
+        )
+        self.stats_store.incr(f"cancel:{reason}:{'ok' if cancelled else 'failed'}")
+        if cancelled and remaining > 0:
+            self.stats_store.incr(f"cancel:{reason}:reclaimed_seconds", int(remaining))
+        return cancelled
+
+    def _is_stop_command(self, body: dict) -> bool:
+        if not self.valves.stop_command:
+            return False
+        content = body["messages"][-1]["content"]
+        if isinstance(content, list):
+            content = "".join(item.get("text", "") for item in content if item.get("type") == "text")
+        return isinstance(content, str) and content.strip() == self.valves.stop_command
+
+    async def _check_disconnected(self, __request__: Request) -> None:
+        if self.valves.cancel_on_disconnect and await __request__.is_disconnected():
+            raise ClientDisconnectedError()
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # one pooled client per worker, requests in flight keep the previous one after a config change
+        config = (self.valves.api_key, self.valves.proxy or None, self.valves.timeout, self.valves.connect_timeout)
+        if self._client is None or self._client.is_closed or self._client_config != config:
+            if self._client is not None and not self._client.is_closed:
+                closing = asyncio.create_task(self._close_client(self._client))
+                self._closing_clients.add(closing)
+                closing.add_done_callback(self._closing_clients.discard)
+            self._client = httpx.AsyncClient(
+                headers={"x-goog-api-key": self.valves.api_key},
+                proxy=self.valves.proxy or None,
+                trust_env=True,
+                timeout=httpx.Timeout(
+                    self.valves.timeout, connect=self.valves.connect_timeout, pool=self.valves.connect_timeout
+                ),
+            )
+            self._client_config = config
+        return self._client
+
+    async def _close_client(self, client: httpx.AsyncClient) -> None:
+        # running tasks hold the client for at most the task timeout
+        await asyncio.sleep(self.valves.task_timeout + self.valves.timeout)
+        await client.aclose()
+
+    def _task_key(self, __user__: dict, __metadata__: dict, payload: dict) -> str:
+        digest = hashlib.sha256(json.dumps(payload["json"], sort_keys=True).encode()).hexdigest()
+        return f"{__metadata__.get('chat_id') or __user__['id']}:{digest}"
+
+    def _resume_task(self, task_key: str, message_id: str) -> Optional[dict]:
+        cached = self.task_store.get(task_key)
+        if not cached:
+            return None
+        task = json.loads(cached)
+        # a retry renders into a new message, so everything is sent again
+        if task.get("message_id") != message_id:
+            task["message_id"] = message_id
+            task["last_event_id"] = ""
+            task["emitted"] = {}
+        return task
+
+    def _save_task(self, task: dict) -> None:
+        ttl = int(task["started_at"] + self.valves.task_timeout - time.time())
+        if ttl > 0:
+            self.task_store.set(task["key"], json.dumps(task), ttl=ttl)
+
+    async def _stream_results(
+        self,
+        __request__: Request,
+        user: UserModel,
+        client: httpx.AsyncClient,
+        url: str,
+        model: str,
+        task: dict,
+        end_time: float,
+    ) -> AsyncIterable:
+        received = False
+        saved_at = time.time()
+        while time.time() < end_time:
+            params = {"stream": "true", "alt": "sse"}
+            if task["last_event_id"]:
+                params["last_event_id"] = task["last_event_id"]
+            try:
+                async with client.stream("GET", url, params=params) as response:
+                    if response.status_code != 200:
+                        text = (await response.aread()).decode(errors="replace")
+                        # stream never opened, let the caller poll instead
+                        if not received:
+                            raise StreamUnavailableError(f"{response.status_code}: {text}")
+                        logger.error(
+                            "[GeminiDeepResearchPipe] response invalid with %d: %s", response.status_code, text
+                        )
+                        raise APIException(response.status_code, text, response)
+                    if "text/event-stream" not in response.headers.get("content-type", "") and not received:
+                        raise StreamUnavailableError(f"unexpected content type {response.headers.get('content-type')}")
+                    async for line in response.aiter_lines():
+                        line = line.strip()
+                        if line.startswith("id:"):
+                            task["last_event_id"] = line[3:].strip()
+                            continue
+                        if not line.startswith("data:"):
+                            continue
+                        line = line[5:].strip()
+                        if not line or line == "[DONE]":
+                            continue
+                        event = json.loads(line)
+                        received = True
+                        task["last_event_id"] = event.get("event_id") or task["last_event_id"]
+                        # keep the resume cursor fresh without writing on every delta
+                        if time.time() - saved_at >= self.valves.check_interval:
+                            self._save_task(task)
+                            saved_at = time.time()
+                            await self._check_disconnected(__request__)
+                        match event.get("event_type"):
+                            case "interaction.start" | "interaction.status_update":
+                                resp_data = event.get("interaction") or event
+                                if resp_data.get("status"):
+                                    yield self._task_status(task, resp_data)
+                                # failed or cancelled tasks end without a complete event
+                                if self._task_finished(task["last_status"]):
+                                    yield self._format_data(
+                                        is_stream=True, model=model, usage=self._format_usage(resp_data.get("usage"))
+                                    )
+                                    return
+                            case "content.delta":
+                                content = await self._format_output(__request__, user, task, event.get("delta") or {})
+                                if content:
+                                    yield self._format_data(is_stream=True, model=model, content=content)
+                            case "interaction.complete":
+                                resp_data = event.get("interaction") or {}
+                                # the final event may omit usage, fetch it once
+                                if not resp_data.get("usage"):
+                                    final_response = await client.get(url)
+                                    if final_response.status_code == 200:
+                                        resp_data = final_response.json()
+                                resp_data.setdefault("status", "completed")
+                                yield self._task_status(task, resp_data)
+                                yield self._format_data(
+                                    is_stream=True, model=model, usage=self._format_usage(resp_data.get("usage"))
+                                )
+                                return
+                            case "error":
+                                raise APIException(response.status_code, line, response)
+            except httpx.RequestError as err:
+                if not received:
+                    raise StreamUnavailableError(str(err)) from err
+                logger.warning(
+                    "[GeminiDeepResearchPipe] stream interrupted, resume from %s: %s", task["last_event_id"], err
+                )
+            # stream closed before the task finished, reconnect from the last event
+            await asyncio.sleep(self.valves.check_interval)
+        raise TimeoutError("[GeminiDeepResearchPipe] task timeout")
+
+    async def _poll_results(
+        self, __request__: Request, user: UserModel, url: str, model: str, task: dict, end_time: float
+    ) -> AsyncIterable:
+        poll_key, queue = self.poller.register(
+            url=url,
+            get_client=self._get_client,
+            min_interval=self.valves.check_interval,
+            max_interval=self.valves.max_check_interval,
+        )
+        try:
             while time.time() < end_time:
+                # the shared poller only hands over responses that changed
                 try:
-                    response = await client.get(url)
-                except httpx.RequestError as e:
-                    logger.error("[GeminiDeepResearchPipe] request error: %s", e)
-                    await asyncio.sleep(self.valves.check_interval)
+                    response = await asyncio.wait_for(
+                        queue.get(), timeout=min(end_time - time.time(), self.valves.max_check_interval)
+                    )
+                except asyncio.TimeoutError:
+                    await self._check_disconnected(__request__)
                     continue
                 # check resp
                 if response.status_code != 200:
@@ -136,46 +672,102 @@ class Pipe:
                     raise APIException(response.status_code, response.text, response)
                 # parse resp
                 resp_data = response.json()
-                yield self._task_status(last_status, resp_data)
-                # format content
-                for output in resp_data.get("outputs", []) or []:
-                    match output["type"]:
-                        case "text":
-                            yield self._format_data(is_stream=True, model=model, content=output["text"])
-                        case "image":
-                            image_data = output["data"]
-                            mime_type = output["mime_type"]
-                            image_url = f"data:{mime_type};base64,{image_data}"
-                            yield self._format_data(
-                                is_stream=True,
-                                model=model,
-                                content=f"![image]({image_url})",
-                            )
-                        case _:
-                            continue
+                yield self._task_status(task, resp_data)
+                # format content, only what has not been sent yet
+                for index, output in enumerate(resp_data.get("outputs", []) or []):
+                    output = self._output_delta(task["emitted"], index, output)
+                    content = await self._format_output(__request__, user, task, output) if output else ""
+                    if content:
+                        yield self._format_data(is_stream=True, model=model, content=content)
+                self._save_task(task)
                 # check finished
-                if self._task_finished(last_status["last_status"]):
-                    # format usage data
-                    usage_metadata = resp_data.get("usage", None) or {}
-                    usage = {
-                        "prompt_tokens": (usage_metadata.pop("total_input_tokens", 0) if usage_metadata else 0),
-                        "completion_tokens": (usage_metadata.pop("total_output_tokens", 0) if usage_metadata else 0),
-                        "total_tokens": (usage_metadata.pop("total_tokens", 0) if usage_metadata else 0),
-                        "prompt_tokens_details": {
-                            "cached_tokens": (usage_metadata.get("total_cached_tokens", 0) if usage_metadata else 0)
-                        },
-                        "metadata": usage_metadata or {},
-                    }
-                    if usage_metadata and "total_tool_use_tokens" in usage_metadata:
-                        usage["prompt_tokens"] += usage_metadata["total_tool_use_tokens"]
-                    if usage_metadata and "total_reasoning_tokens" in usage_metadata:
-                        usage["completion_tokens"] += usage_metadata["total_reasoning_tokens"]
-                    if usage["prompt_tokens"] + usage["completion_tokens"] != usage["total_tokens"]:
-                        usage["completion_tokens"] = usage["total_tokens"] - usage["prompt_tokens"]
-                    yield self._format_data(is_stream=True, model=model, usage=usage)
+                if self._task_finished(task["last_status"]):
+                    yield self._format_data(
+                        is_stream=True, model=model, usage=self._format_usage(resp_data.get("usage"))
+                    )
                     return
-                await asyncio.sleep(self.valves.check_interval)
-            raise TimeoutError("[GeminiDeepResearchPipe] task timeout")
+        finally:
+            self.poller.unregister(poll_key)
+        raise TimeoutError("[GeminiDeepResearchPipe] task timeout")
+
+    def _output_delta(self, emitted: Dict[str, Tuple[int, str]], index: int, output: dict) -> Optional[dict]:
+        # output index -> (emitted length, hash of the emitted content), keyed by str to survive json
+        index = str(index)
+        is_text = output.get("type") == "text"
+        content = output.get("text", "") if is_text else output.get("data", "")
+        if not content:
+            return None
+        if index in emitted:
+            length, digest = emitted[index]
+            if hashlib.sha256(content[:length].encode()).hexdigest() == digest:
+                suffix = content[length:]
+                # text grows in place, other outputs are sent whole once
+                if not suffix or is_text:
+                    emitted[index] = (len(content), hashlib.sha256(content.encode()).hexdigest())
+                    return {**output, "text": suffix} if suffix else None
+        emitted[index] = (len(content), hashlib.sha256(content.encode()).hexdigest())
+        return output
+
+    async def _format_output(self, __request__: Request, user: UserModel, task: dict, output: dict) -> str:
+        match output.get("type"):
+            case "text":
+                return output.get("text", "")
+            case "image":
+                # persist once per task, the message only carries the file url
+                images = task.setdefault("images", {})
+                digest = hashlib.sha256(output["data"].encode()).hexdigest()
+                if digest not in images:
+                    loop = asyncio.get_running_loop()
+                    try:
+                        images[digest] = await loop.run_in_executor(
+                            self.upload_executor,
+                            partial(
+                                self._upload_image,
+                                __request__=__request__,
+                                user=user,
+                                image_data=output["data"],
+                                mime_type=output["mime_type"],
+                            ),
+                        )
+                    except Exception as err:
+                        logger.error("[GeminiDeepResearchPipe] upload image failed: %s", err)
+                        return f"![image](data:{output['mime_type']};base64,{output['data']})"
+                image_url = __request__.app.url_path_for("get_file_content_by_id", id=images[digest])
+                return f"![image]({image_url})"
+            case _:
+                return ""
+
+    def _upload_image(self, __request__: Request, user: UserModel, image_data: str, mime_type: str) -> str:
+        file_item = upload_file(
+            request=__request__,
+            background_tasks=BackgroundTasks(),
+            file=UploadFile(
+                file=io.BytesIO(base64.b64decode(image_data)),
+                filename=f"deep-research-image-{uuid.uuid4().hex}.{mime_type.split('/')[-1]}",
+                headers=Headers({"content-type": mime_type}),
+            ),
+            process=False,
+            user=user,
+            metadata={"mime_type": mime_type},
+        )
+        return file_item.id
+
+    def _format_usage(self, usage_metadata: Optional[dict]) -> dict:
+        usage_metadata = dict(usage_metadata or {})
+        usage = {
+            "prompt_tokens": usage_metadata.pop("total_input_tokens", 0),
+            "completion_tokens": usage_metadata.pop("total_output_tokens", 0),
+            "total_tokens": usage_metadata.pop("total_tokens", 0),
+            "prompt_tokens_details": {"cached_tokens": usage_metadata.get("total_cached_tokens", 0)},
+            "metadata": usage_metadata,
+        }
+        if "total_tool_use_tokens" in usage_metadata:
+            usage["prompt_tokens"] += usage_metadata["total_tool_use_tokens"]
+        if "total_reasoning_tokens" in usage_metadata:
+            usage["completion_tokens"] += usage_metadata["total_reasoning_tokens"]
+        if usage["prompt_tokens"] + usage["completion_tokens"] != usage["total_tokens"]:
+            usage["completion_tokens"] = usage["total_tokens"] - usage["prompt_tokens"]
+        return usage
 
     async def _build_payload(self, body: dict) -> Tuple[str, dict]:
         # payload
@@ -276,20 +868,23 @@ class Pipe:
             data["usage"] = usage
         return f"data: {json.dumps(data)}\n\n"
 
-    def _task_status(self, last_status: dict, resp_data: dict) -> str:
+    def _task_status(self, task: dict, resp_data: dict) -> str:
         new_status = str(resp_data["status"]).capitalize()
-        if last_status["last_status"] == new_status:
+        if task["last_status"] == new_status:
             return ""
-        last_status["last_status"] = new_status
-        data = {
-            "event": {
-                "type": "status",
-                "data": {
-                    "description": f"Deep Research Status: {' '.join([i.capitalize() for i in new_status.split('_')])}",
-                    "done": self._task_finished(new_status),
-                },
-            }
-        }
+        task["last_status"] = new_status
+        return self._format_status(new_status)
+
+    def _format_status(self, new_status: str) -> str:
+        if not new_status:
+            return ""
+        return self._format_event(
+            description=f"Deep Research Status: {' '.join([i.capitalize() for i in new_status.split('_')])}",
+            done=self._task_finished(new_status),
+        )
+
+    def _format_event(self, description: str, done: bool) -> str:
+        data = {"event": {"type": "status", "data": {"description": description, "done": done}}}
         return f"data: {json.dumps(data)}\n\n"
 
     def _task_finished(self, task_status: str) -> bool:
@@ -3,24 +3,51 @@ title: Gemini Image
 description: Image generation with Gemini
 author: OVINC CN
 git_url: https://github.com/OVINC-CN/OpenWebUIPlugin.git
-version: 0.0.11
+version: 0.0.25
 licence: MIT
 """
 
+import asyncio
 import base64
+import binascii
+import hashlib
 import io
 import json
 import logging
+import threading
 import time
 import uuid
-from typing import AsyncIterable, Literal, Optional, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from tempfile import SpooledTemporaryFile
+from typing import (
+    AsyncIterable,
+    BinaryIO,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import httpx
 from fastapi import BackgroundTasks, Request, UploadFile
 from httpx import Response
-from open_webui.env import GLOBAL_LOG_LEVEL
+from open_webui.env import (
+    GLOBAL_LOG_LEVEL,
+    REDIS_SENTINEL_HOSTS,
+    REDIS_SENTINEL_PORT,
+    REDIS_URL,
+)
+from open_webui.models.files import Files
 from open_webui.models.users import UserModel, Users
 from open_webui.routers.files import get_file_content_by_id, upload_file
+from open_webui.utils.redis import get_redis_connection, get_sentinels_from_env
+from PIL import Image, ImageOps
 from pydantic import BaseModel, Field
 from starlette.datastructures import Headers
 from starlette.responses import StreamingResponse
@@ -28,6 +55,11 @@ from starlette.responses import StreamingResponse
 logger = logging.getLogger(__name__)
 logger.setLevel(GLOBAL_LOG_LEVEL)
 
+UPLOAD_MAX_WORKERS = 4
+SPOOL_MAX_SIZE = 1024 * 1024
+BASE64_FILE_PLACEHOLDER = "__base64_file_"
+GEMINI_FILE_TTL = 48 * 3600
+
 
 class APIException(Exception):
     def __init__(self, status: int, content: str, response: Response):
@@ -49,6 +81,214 @@ class APIException(Exception):
         return "Unknown API error"
 
 
+class Base64FieldExtractor:
+    def __init__(self, fields: Set[str], max_memory: int = SPOOL_MAX_SIZE):
+        self.fields = {field.encode() for field in fields}
+        self.max_memory = max_memory
+        self.files: List[SpooledTemporaryFile] = []
+        self._skeleton = bytearray()
+        self._string = bytearray()
+        self._in_string = False
+        self._escape = False
+        self._last_string: Optional[bytes] = None
+        self._pending_key: Optional[bytes] = None
+        self._capture: Optional[SpooledTemporaryFile] = None
+        self._capture_escape = False
+        self._rest = b""
+
+    def feed(self, chunk: bytes) -> None:
+        index = 0
+        length = len(chunk)
+        while index < length:
+            # base64 value, decoded straight into a spooled file
+            if self._capture is not None:
+                if self._capture_escape:
+                    self._capture_escape = False
+                    if chunk[index] == ord("/"):
+                        self._write(b"/")
+                    index += 1
+                    continue
+                quote = chunk.find(b'"', index)
+                escape = chunk.find(b"\\", index, quote if quote >= 0 else length)
+                stop = escape if escape >= 0 else (quote if quote >= 0 else length)
+                self._write(chunk[index:stop])
+                if stop == length:
+                    return
+                if stop == escape:
+                    self._capture_escape = True
+                else:
+                    self._finish()
+                index = stop + 1
+                continue
+            # regular json
+            char = chunk[index]
+            if self._in_string:
+                self._skeleton.append(char)
+                if self._escape:
+                    self._escape = False
+                    self._string.append(char)
+                elif char == ord("\\"):
+                    self._escape = True
+                elif char == ord('"'):
+                    self._in_string = False
+                    self._last_string = bytes(self._string)
+                else:
+                    self._string.append(char)
+            elif char == ord('"'):
+                if self._pending_key in self.fields:
+                    self._capture = SpooledTemporaryFile(max_size=self.max_memory)
+                    self._rest = b""
+                else:
+                    self._skeleton.append(char)
+                    self._in_string = True
+                    self._string.clear()
+                self._pending_key = None
+            else:
+                self._skeleton.append(char)
+                if char == ord(":"):
+                    self._pending_key = self._last_string
+                    self._last_string = None
+                elif char not in b" \t\r\n":
+                    # whitespace may sit between a key and its colon
+                    self._pending_key = None
+                    self._last_string = None
+            index += 1
+
+    def result(self) -> dict:
+        return json.loads(bytes(self._skeleton))
+
+    def file(self, value: str) -> SpooledTemporaryFile:
+        image_file = self.files[int(value[len(BASE64_FILE_PLACEHOLDER) :])]
+        image_file.seek(0)
+        return image_file
+
+    def close(self) -> None:
+        if self._capture is not None:
+            self._capture.close()
+        for image_file in self.files:
+            image_file.close()
+
+    def _write(self, data: bytes) -> None:
+        data = self._rest + data
+        usable = len(data) - len(data) % 4
+        self._rest = data[usable:]
+        if usable:
+            self._capture.write(binascii.a2b_base64(data[:usable]))
+
+    def _finish(self) -> None:
+        if self._rest:
+            self._capture.write(binascii.a2b_base64(self._rest + b"=" * (-len(self._rest) % 4)))
+        self._skeleton.extend(f'"{BASE64_FILE_PLACEHOLDER}{len(self.files)}"'.encode())
+        self.files.append(self._capture)
+        self._capture = None
+        self._rest = b""
+
+
+class ImageCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: OrderedDict[str, dict] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item["data"], item["mime_type"]
+
+    def get_base64(self, key: str) -> Optional[Tuple[str, str]]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            # encode lazily and keep the result for later turns
+            if item["base64"] is None:
+                item["base64"] = base64.b64encode(item["data"]).decode()
+                self._size += len(item["base64"])
+                self._evict()
+            return item["base64"], item["mime_type"]
+
+    def set(self, key: str, data: bytes, mime_type: str) -> None:
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._items[key] = {"data": data, "mime_type": mime_type, "base64": None}
+            self._size += len(data)
+            self._evict()
+
+    def _remove(self, key: str) -> None:
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._size -= len(item["data"]) + len(item["base64"] or "")
+
+    def _evict(self) -> None:
+        while self._size > self.max_bytes and len(self._items) > 1:
+            self._remove(next(iter(self._items)))
+
+
+class ImageIndex:
+    def __init__(self, prefix: str, max_items: int = 10000):
+        self.prefix = prefix
+        self.max_items = max_items
+        self._items: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = get_redis_connection(
+            redis_url=REDIS_URL,
+            redis_sentinels=get_sentinels_from_env(REDIS_SENTINEL_HOSTS, REDIS_SENTINEL_PORT),
+            decode_responses=True,
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        key = f"{self.prefix}:{key}"
+        # shared index
+        if self._redis is not None:
+            try:
+                return self._redis.get(key)
+            except Exception as err:
+                logger.warning("[ImageIndex] redis get failed: %s", err)
+        # local index
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[1] < time.time():
+                self._items.pop(key, None)
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        key = f"{self.prefix}:{key}"
+        # shared index
+        if self._redis is not None:
+            try:
+                self._redis.set(key, value, ex=ttl)
+                return
+            except Exception as err:
+                logger.warning("[ImageIndex] redis set failed: %s", err)
+        # local index
+        with self._lock:
+            self._items[key] = (value, time.time() + ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        key = f"{self.prefix}:{key}"
+        if self._redis is not None:
+            try:
+                self._redis.delete(key)
+            except Exception as err:
+                logger.warning("[ImageIndex] redis delete failed: %s", err)
+        with self._lock:
+            self._items.pop(key, None)
+
+
 class Pipe:
     class Valves(BaseModel):
         base_url: str = Field(
@@ -56,9 +296,39 @@ class Pipe:
             title="Base URL",
         )
         api_key: str = Field(default="", title="API Key")
+        num_of_images: int = Field(default=1, title="图片数量", ge=1, le=10)
+        max_concurrency: int = Field(default=4, title="最大并发请求数", ge=1)
+        enable_stream: bool = Field(
+            default=False, title="流式响应", description="仅在图片数量为1时生效，实时输出文本与思考内容"
+        )
+        include_thoughts: bool = Field(default=False, title="输出思考内容")
+        seed: int = Field(default=-1, title="随机种子", description="不小于0时第N张图片使用 seed+N，小于0表示随机")
         timeout: int = Field(default=600, title="请求超时时间 (秒)")
+        connect_timeout: int = Field(default=10, title="连接超时时间 (秒)", ge=1)
+        image_cache_size: int = Field(default=256, title="参考图缓存大小 (MB)", ge=0)
+        reference_max_size: int = Field(
+            default=2048, title="参考图最大边长 (像素)", ge=0, description="上传前缩放用户参考图，0 表示不处理"
+        )
+        reference_format: Literal["webp", "jpeg"] = Field(default="webp", title="参考图编码格式")
+        reference_quality: int = Field(default=85, title="参考图编码质量", ge=1, le=100)
+        output_format: Literal["original", "webp", "avif"] = Field(
+            default="original",
+            title="生成图片存储格式",
+            description="AVIF 需要 Pillow 支持，不支持时使用 WebP；部分服务商不接受 AVIF 作为编辑参考图",
+        )
+        output_quality: int = Field(default=90, title="生成图片编码质量", ge=1, le=100)
+        thumbnail_size: int = Field(default=0, title="缩略图最大边长 (像素)", ge=0, description="0 表示不生成缩略图")
+        enable_dedupe: bool = Field(default=True, title="相同图片复用已存储文件")
+        dedupe_ttl: int = Field(default=30, title="去重索引有效期 (天)", ge=1)
         proxy: Optional[str] = Field(default="", title="代理地址")
         models: str = Field(default="gemini-3-pro-image-preview", title="模型", description="使用英文逗号分隔多个模型")
+        enable_file_upload: bool = Field(
+            default=False, title="大文件上传到文件接口", description="较大的图片通过 Files API 上传一次，48 小时内复用"
+        )
+        file_upload_min_size: int = Field(default=256, title="上传文件最小大小 (KB)", ge=0)
+        upload_url: str = Field(
+            default="https://generativelanguage.googleapis.com/upload/v1beta/files", title="上传地址"
+        )
         response_modalities: Literal["TEXT", "IMAGE", "TEXT,IMAGE"] = Field(
             default="IMAGE", title="响应模态", description="使用英文逗号分隔"
         )
@@ -72,6 +342,13 @@ class Pipe:
     def __init__(self):
         self.valves = self.Valves()
         self.user_valves = self.UserValves()
+        self.upload_executor = ThreadPoolExecutor(
+            max_workers=UPLOAD_MAX_WORKERS, thread_name_prefix="gemini-image-upload"
+        )
+        self.image_cache = ImageCache(max_bytes=self.valves.image_cache_size * 1024 * 1024)
+        self.reference_cache = ImageCache(max_bytes=self.valves.image_cache_size * 1024 * 1024)
+        self.image_index = ImageIndex(prefix="gemini_image:dedupe")
+        self.file_registry = ImageIndex(prefix="gemini_image:file")
 
     def pipes(self):
         return [{"id": model, "name": model} for model in self.valves.models.split(",")]
@@ -86,92 +363,572 @@ class Pipe:
 
     async def _pipe(self, body: dict, __user__: dict, __request__: Request) -> AsyncIterable:
         user = Users.get_user_by_id(__user__["id"])
+        self.image_cache.max_bytes = self.valves.image_cache_size * 1024 * 1024
+        self.reference_cache.max_bytes = self.valves.image_cache_size * 1024 * 1024
         model, payload = await self._build_payload(user=user, body=body, user_valves=__user__["valves"])
         # call client
         async with httpx.AsyncClient(
             headers={"x-goog-api-key": self.valves.api_key},
             proxy=self.valves.proxy or None,
             trust_env=True,
-            timeout=self.valves.timeout,
+            timeout=httpx.Timeout(
+                self.valves.timeout, connect=self.valves.connect_timeout, pool=self.valves.connect_timeout
+            ),
         ) as client:
-            response = await client.post(**payload)
-            if response.status_code != 200:
-                raise APIException(status=response.status_code, content=response.text, response=response)
-            response = response.json()
-            # upload image
-            results = []
-            for item in response["candidates"]:
-                content = item.get("content", {})
-                if not content:
-                    results.append(item.get("finishReason", ""))
+            offloaded, file_uris = (
+                await self._offload_media(client, payload) if self.valves.enable_file_upload else (None, {})
+            )
+            for request_payload in [offloaded, payload] if offloaded else [payload]:
+                try:
+                    async for item in self._generate_response(
+                        client=client,
+                        __request__=__request__,
+                        user=user,
+                        model=model,
+                        body=body,
+                        payload=request_payload,
+                    ):
+                        yield item
+                except APIException as err:
+                    # an uploaded file may have expired, forget it and resend the media inline
+                    # pylint: disable=W0212
+                    if request_payload is offloaded and self._is_file_error(err._status, err._content):
+                        await self._forget_files(file_uris, err._content)
+                        continue
+                    raise
+                break
+
+    # pylint: disable=R0913,R0917
+    async def _generate_response(
+        self,
+        client: httpx.AsyncClient,
+        __request__: Request,
+        user: UserModel,
+        model: str,
+        body: dict,
+        payload: dict,
+    ) -> AsyncIterable:
+        # stream text and thoughts as they arrive
+        if self.valves.enable_stream and self.valves.num_of_images == 1:
+            async for item in self._stream_generate(
+                client=client,
+                __request__=__request__,
+                user=user,
+                model=model,
+                payload=payload,
+                is_stream=body.get("stream", False),
+            ):
+                yield item
+            return
+
+        # fan out one request per image, uploading each variant as soon as it finishes
+        semaphore = asyncio.Semaphore(self.valves.max_concurrency)
+        tasks = [
+            asyncio.create_task(
+                self._generate(
+                    client=client,
+                    semaphore=semaphore,
+                    __request__=__request__,
+                    user=user,
+                    payload=self._variant_payload(payload, index),
+                )
+            )
+            for index in range(self.valves.num_of_images)
+        ]
+        results = []
+        usage_metadata = {}
+        errors = []
+        try:
+            for task in asyncio.as_completed(tasks):
+                try:
+                    variant_results, variant_usage = await task
+                except Exception as err:
+                    logger.error("[GeminiImagePipe] variant failed: %s", err)
+                    errors.append(err)
                     continue
-                parts = content.get("parts", [])
-                if not parts:
-                    results.append(item.get("finishReason", ""))
+                variant_content = "\n\n".join(variant_results)
+                if body.get("stream") and variant_content:
+                    yield self._format_data(
+                        is_stream=True,
+                        model=model,
+                        content=f"\n\n{variant_content}" if results else variant_content,
+                    )
+                results.append(variant_content)
+                for key, val in variant_usage.items():
+                    if isinstance(val, int):
+                        usage_metadata[key] = usage_metadata.get(key, 0) + val
+                    else:
+                        usage_metadata.setdefault(key, val)
+        finally:
+            for task in tasks:
+                task.cancel()
+        if errors and not results:
+            raise errors[0]
+
+        # format response data
+        usage = self._format_usage(usage_metadata)
+
+        # response
+        content = "\n\n".join(results)
+        if body.get("stream"):
+            yield self._format_data(is_stream=True, model=model, content=None, usage=usage)
+        else:
+            yield self._format_data(is_stream=False, model=model, content=content, usage=usage)
+
+    # pylint: disable=R0913,R0917
+    async def _generate(
+        self,
+        client: httpx.AsyncClient,
+        semaphore: asyncio.Semaphore,
+        __request__: Request,
+        user: UserModel,
+        payload: dict,
+    ) -> Tuple[List[str], dict]:
+        async with semaphore:
+            extractor = await self._request_images(client=client, payload=payload, fields={"data"})
+        try:
+            response = extractor.result()
+            # upload image
+            results = await self._parse_candidates(
+                __request__=__request__, user=user, candidates=response["candidates"], extractor=extractor
+            )
+        finally:
+            extractor.close()
+        return results, response.get("usageMetadata") or {}
+
+    # pylint: disable=R0913,R0917
+    async def _stream_generate(
+        self,
+        client: httpx.AsyncClient,
+        __request__: Request,
+        user: UserModel,
+        model: str,
+        payload: dict,
+        is_stream: bool,
+    ) -> AsyncIterable:
+        url = payload["url"].replace(":generateContent", ":streamGenerateContent")
+        url = f"{url}{'&' if '?' in url else '?'}alt=sse"
+        if is_stream:
+            yield self._format_status(description="Generating image", done=False)
+        usage_metadata = {}
+        has_content = False
+        held_text = ""
+        # non stream requests still read the stream, but answer with a single message
+        contents = []
+        reasoning_contents = []
+        async with client.stream("POST", **{**payload, "url": url}) as response:
+            if response.status_code != 200:
+                text = ""
+                async for line in response.aiter_lines():
+                    text += line  # pylint: disable=R1713
+                logger.error("response invalid with %d: %s", response.status_code, text)
+                raise APIException(status=response.status_code, content=text, response=response)
+            async for line in response.aiter_lines():
+                line = line.strip()
+                if not line.startswith("data:"):
                     continue
-                for part in parts:
-                    if "text" in part:
-                        if part["text"].endswith("`"):
-                            results.append(part["text"][:-1])
-                        else:
-                            results.append(part["text"])
-                    if "inlineData" in part:
-                        inline_data = part["inlineData"]
-                        results.append(
-                            self._upload_image(
+                line = json.loads(line[5:])
+                usage_metadata = line.get("usageMetadata") or usage_metadata
+                for item in line.get("candidates", []):
+                    for part in (item.get("content") or {}).get("parts", []):
+                        # thinking content
+                        if part.get("thought"):
+                            if part.get("text") and is_stream:
+                                yield self._format_data(is_stream=True, model=model, reasoning_content=part["text"])
+                            elif part.get("text"):
+                                reasoning_contents.append(part["text"])
+                            continue
+                        # text content
+                        if part.get("text"):
+                            has_content = True
+                            # only a backtick that ends the text is dropped, hold it back until more text arrives
+                            text = held_text + part["text"]
+                            held_text = "`" if text.endswith("`") else ""
+                            text = text[:-1] if held_text else text
+                            if text and is_stream:
+                                yield self._format_data(is_stream=True, model=model, content=text)
+                            elif text:
+                                contents.append(text)
+                        # image content, persisted as soon as the part is complete
+                        if "inlineData" in part:
+                            held_text = ""
+                            if is_stream:
+                                yield self._format_status(description="Uploading image", done=False)
+                            inline_data = part["inlineData"]
+                            result = await self._upload_images(
                                 __request__=__request__,
                                 user=user,
-                                image_data=inline_data["data"],
-                                mime_type=inline_data["mimeType"],
+                                images=[(inline_data["data"], inline_data["mimeType"])],
                             )
-                        )
-
-            # format response data
-            usage_metadata = response.get("usageMetadata", None)
-            usage = {
-                "prompt_tokens": usage_metadata.pop("promptTokenCount", 0) if usage_metadata else 0,
-                "completion_tokens": usage_metadata.pop("candidatesTokenCount", 0) if usage_metadata else 0,
-                "total_tokens": usage_metadata.pop("totalTokenCount", 0) if usage_metadata else 0,
-                "prompt_tokens_details": {
-                    "cached_tokens": (usage_metadata.get("cachedContentTokenCount", 0) if usage_metadata else 0)
-                },
-                "metadata": usage_metadata or {},
-            }
-            if usage_metadata and "toolUsePromptTokenCount" in usage_metadata:
-                usage["prompt_tokens"] += usage_metadata["toolUsePromptTokenCount"]
-            if usage_metadata and "thoughtsTokenCount" in usage_metadata:
-                usage["completion_tokens"] += usage_metadata["thoughtsTokenCount"]
-            if usage["prompt_tokens"] + usage["completion_tokens"] != usage["total_tokens"]:
-                usage["completion_tokens"] = usage["total_tokens"] - usage["prompt_tokens"]
-
-            # response
-            content = "\n\n".join(results)
-            if body.get("stream"):
-                yield self._format_data(is_stream=True, model=model, content=content, usage=None)
-                yield self._format_data(is_stream=True, model=model, content=None, usage=usage)
-            else:
-                yield self._format_data(is_stream=False, model=model, content=content, usage=usage)
+                            image_content = f"\n\n{result[0]}\n\n" if has_content else result[0]
+                            if is_stream:
+                                yield self._format_data(is_stream=True, model=model, content=image_content)
+                            else:
+                                contents.append(image_content)
+                            has_content = True
+                    if not has_content and item.get("finishReason", "") not in ("", "STOP"):
+                        if is_stream:
+                            yield self._format_data(is_stream=True, model=model, content=item["finishReason"])
+                        else:
+                            contents.append(item["finishReason"])
+        usage = self._format_usage(usage_metadata)
+        if not is_stream:
+            yield self._format_data(
+                is_stream=False,
+                model=model,
+                content="".join(contents),
+                reasoning_content="".join(reasoning_contents),
+                usage=usage,
+            )
+            return
+        yield self._format_status(description="Image generated", done=True)
+        yield self._format_data(is_stream=True, model=model, usage=usage)
+
+    def _variant_payload(self, payload: dict, index: int) -> dict:
+        if self.valves.seed < 0:
+            return payload
+        generation_config = {**payload["json"]["generationConfig"], "seed": self.valves.seed + index}
+        return {**payload, "json": {**payload["json"], "generationConfig": generation_config}}
+
+    async def _parse_candidates(
+        self, __request__: Request, user: UserModel, candidates: List[dict], extractor: Base64FieldExtractor
+    ) -> List[str]:
+        results = []
+        images = []
+        for item in candidates:
+            content = item.get("content", {})
+            if not content:
+                results.append(item.get("finishReason", ""))
+                continue
+            parts = content.get("parts", [])
+            if not parts:
+                results.append(item.get("finishReason", ""))
+                continue
+            for part in parts:
+                if part.get("thought"):
+                    continue
+                if "text" in part:
+                    if part["text"].endswith("`"):
+                        results.append(part["text"][:-1])
+                    else:
+                        results.append(part["text"])
+                if "inlineData" in part:
+                    inline_data = part["inlineData"]
+                    images.append((extractor.file(inline_data["data"]), inline_data["mimeType"]))
+                    results.append(None)
+        uploaded = iter(await self._upload_images(__request__=__request__, user=user, images=images))
+        return [next(uploaded) if item is None else item for item in results]
+
+    async def _request_images(self, client: httpx.AsyncClient, payload: dict, fields: Set[str]) -> Base64FieldExtractor:
+        # decode base64 fields while reading so that images are never held as json strings
+        async with client.stream("POST", **payload) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise APIException(status=response.status_code, content=response.text, response=response)
+            extractor = Base64FieldExtractor(fields=fields)
+            try:
+                async for chunk in response.aiter_bytes():
+                    extractor.feed(chunk)
+            except BaseException:
+                extractor.close()
+                raise
+            return extractor
+
+    async def _upload_images(
+        self, __request__: Request, user: UserModel, images: List[Tuple[Union[str, BinaryIO], str]]
+    ) -> List[str]:
+        # decode and persist images concurrently without blocking the event loop
+        loop = asyncio.get_running_loop()
+        return list(
+            await asyncio.gather(
+                *[
+                    loop.run_in_executor(
+                        self.upload_executor,
+                        partial(
+                            self._upload_image,
+                            __request__=__request__,
+                            user=user,
+                            image_data=image_data,
+                            mime_type=mime_type,
+                        ),
+                    )
+                    for image_data, mime_type in images
+                ]
+            )
+        )
 
-    def _upload_image(self, __request__: Request, user: UserModel, image_data: str, mime_type: str) -> str:
+    def _upload_image(
+        self, __request__: Request, user: UserModel, image_data: Union[str, BinaryIO], mime_type: str
+    ) -> str:
+        image_file = io.BytesIO(base64.b64decode(image_data)) if isinstance(image_data, str) else image_data
+        # hash in chunks so that spooled images are never fully loaded for it
+        hasher = hashlib.blake2b(digest_size=32)
+        for chunk in iter(partial(image_file.read, SPOOL_MAX_SIZE), b""):
+            hasher.update(chunk)
+        image_file.seek(0)
+        # reuse the stored file when the same image has been persisted before
+        index_key = f"{user.id}:{hasher.hexdigest()}"
+        indexed = self.image_index.get(index_key) if self.valves.enable_dedupe else None
+        if indexed:
+            file_id, _, thumbnail_id = indexed.partition(",")
+            if Files.get_file_by_id(file_id):
+                return self._render_image(__request__, file_id, thumbnail_id)
+        # re-encode and build the thumbnail in the worker
+        source_file = image_file
+        image_file, mime_type, thumbnail_file = self._encode_output(image_file, mime_type)
+        try:
+            file_id = self._store_file(__request__, user, image_file, mime_type)
+            thumbnail_id = self._store_file(__request__, user, thumbnail_file, "image/webp") if thumbnail_file else ""
+            # keep the stored version for later edit turns
+            image_file.seek(0, io.SEEK_END)
+            image_size = image_file.tell()
+            image_file.seek(0)
+            self._cache_image(user, file_id, image_file, image_size, mime_type)
+        finally:
+            if image_file is not source_file:
+                image_file.close()
+            if thumbnail_file is not None:
+                thumbnail_file.close()
+        if self.valves.enable_dedupe:
+            self.image_index.set(
+                index_key,
+                f"{file_id},{thumbnail_id}" if thumbnail_id else file_id,
+                ttl=self.valves.dedupe_ttl * 86400,
+            )
+        return self._render_image(__request__, file_id, thumbnail_id)
+
+    def _store_file(self, __request__: Request, user: UserModel, image_file: BinaryIO, mime_type: str) -> str:
         file_item = upload_file(
             request=__request__,
             background_tasks=BackgroundTasks(),
             file=UploadFile(
-                file=io.BytesIO(base64.b64decode(image_data)),
-                filename=f"generated-image-{uuid.uuid4().hex}.png",
+                file=image_file,
+                filename=f"generated-image-{uuid.uuid4().hex}.{mime_type.split('/')[-1]}",
                 headers=Headers({"content-type": mime_type}),
             ),
             process=False,
             user=user,
             metadata={"mime_type": mime_type},
         )
-        image_url = __request__.app.url_path_for("get_file_content_by_id", id=file_item.id)
-        return f"![gemini-image-{file_item.id}]({image_url})"
+        return file_item.id
+
+    def _render_image(self, __request__: Request, file_id: str, thumbnail_id: str) -> str:
+        image_url = __request__.app.url_path_for("get_file_content_by_id", id=file_id)
+        if not thumbnail_id:
+            return f"![gemini-image-{file_id}]({image_url})"
+        thumbnail_url = __request__.app.url_path_for("get_file_content_by_id", id=thumbnail_id)
+        return f"[![gemini-image-{file_id}]({thumbnail_url})]({image_url})"
 
-    async def _get_image_content(self, user: UserModel, markdown_string: str):
+    def _encode_output(self, image_file: BinaryIO, mime_type: str) -> Tuple[BinaryIO, str, Optional[BinaryIO]]:
+        output_format = self.valves.output_format
+        thumbnail_size = self.valves.thumbnail_size
+        if output_format == "original" and thumbnail_size <= 0:
+            return image_file, mime_type, None
+        try:
+            with Image.open(image_file) as image:
+                image.load()
+                if image.mode not in ("RGB", "RGBA"):
+                    image = image.convert("RGBA")
+                # full size image
+                if output_format != "original":
+                    output_file = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+                    try:
+                        image.save(output_file, format=output_format.upper(), quality=self.valves.output_quality)
+                    except (KeyError, OSError):
+                        logger.warning("[%s] %s encoder unavailable, use webp", self.__class__.__name__, output_format)
+                        output_format = "webp"
+                        output_file.seek(0)
+                        output_file.truncate()
+                        image.save(output_file, format="WEBP", quality=self.valves.output_quality)
+                    output_file.seek(0)
+                    image_file, mime_type = output_file, f"image/{output_format}"
+                # thumbnail
+                thumbnail_file = None
+                if thumbnail_size > 0:
+                    image.thumbnail((thumbnail_size, thumbnail_size), Image.Resampling.LANCZOS)
+                    thumbnail_file = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+                    image.save(thumbnail_file, format="WEBP", quality=80)
+                    thumbnail_file.seek(0)
+        except Exception as err:
+            logger.warning("[%s] image encode failed: %s", self.__class__.__name__, err)
+            image_file.seek(0)
+            return image_file, mime_type, None
+        return image_file, mime_type, thumbnail_file
+
+    async def _get_image_content(self, user: UserModel, markdown_string: str) -> Tuple[str, str]:
         file_id = markdown_string.split("![gemini-image-")[1].split("]")[0]
+        cache_key = self._image_cache_key(user, file_id)
+        cached = self.image_cache.get_base64(cache_key)
+        if cached is not None:
+            return cached
         file_response = await get_file_content_by_id(id=file_id, user=user)
-        return open(file_response.path, "rb")
+        loop = asyncio.get_running_loop()
+        image_bytes = await loop.run_in_executor(self.upload_executor, self._read_file, file_response.path)
+        mime_type = file_response.media_type or "image/png"
+        self.image_cache.set(cache_key, image_bytes, mime_type)
+        return self.image_cache.get_base64(cache_key) or (base64.b64encode(image_bytes).decode(), mime_type)
+
+    def _cache_image(
+        self, user: UserModel, file_id: str, image_file: BinaryIO, image_size: int, mime_type: str
+    ) -> None:
+        if image_size > self.image_cache.max_bytes:
+            return
+        self.image_cache.set(self._image_cache_key(user, file_id), image_file.read(), mime_type)
+
+    async def _prepare_reference(self, image_data: str, mime_type: str) -> Tuple[str, str]:
+        if self.valves.reference_max_size <= 0:
+            return image_data, mime_type
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.upload_executor, self._preprocess_image, image_data, mime_type)
+
+    def _preprocess_image(self, image_data: str, mime_type: str) -> Tuple[str, str]:
+        image_bytes = base64.b64decode(image_data)
+        cache_key = self._reference_cache_key(image_bytes)
+        cached = self.reference_cache.get_base64(cache_key)
+        if cached is not None:
+            return cached
+        image_bytes, mime_type = self._transcode_image(image_bytes, mime_type)
+        self.reference_cache.set(cache_key, image_bytes, mime_type)
+        return self.reference_cache.get_base64(cache_key) or (base64.b64encode(image_bytes).decode(), mime_type)
+
+    def _transcode_image(self, image_bytes: bytes, mime_type: str) -> Tuple[bytes, str]:
+        max_size = self.valves.reference_max_size
+        image_format = self.valves.reference_format
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                image = ImageOps.exif_transpose(image)
+                resized = max(image.size) > max_size
+                if resized:
+                    image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+                if image_format == "jpeg" and image.mode != "RGB":
+                    image = image.convert("RGB")
+                elif image.mode not in ("RGB", "RGBA"):
+                    image = image.convert("RGBA")
+                buffer = io.BytesIO()
+                image.save(buffer, format=image_format.upper(), quality=self.valves.reference_quality)
+        except Exception as err:
+            logger.warning("[%s] reference image preprocess failed: %s", self.__class__.__name__, err)
+            return image_bytes, mime_type
+        # keep the original when re-encoding does not make it smaller
+        if not resized and buffer.tell() >= len(image_bytes):
+            return image_bytes, mime_type
+        return buffer.getvalue(), f"image/{image_format}"
+
+    def _reference_cache_key(self, image_bytes: bytes) -> str:
+        digest = hashlib.blake2b(image_bytes, digest_size=32).hexdigest()
+        return (
+            f"{digest}:{self.valves.reference_max_size}:{self.valves.reference_format}:{self.valves.reference_quality}"
+        )
+
+    def _read_file(self, path: str) -> bytes:
+        with open(path, "rb") as file:
+            return file.read()
+
+    def _image_cache_key(self, user: UserModel, file_id: str) -> str:
+        # scope by user so that cached files never bypass the file access check
+        return f"{user.id}:{file_id}"
+
+    async def _offload_media(self, client: httpx.AsyncClient, payload: dict) -> Tuple[Optional[dict], Dict[str, str]]:
+        media = {
+            part["inline_data"]["data"]: part["inline_data"]
+            for content in payload["json"]["contents"]
+            for part in content["parts"]
+            if "inline_data" in part and len(part["inline_data"]["data"]) >= self.valves.file_upload_min_size * 1024
+        }
+        if not media:
+            return None, {}
+        # upload new media once, reference every part by file uri
+        uploads = await asyncio.gather(
+            *[self._upload_media(client, item["data"], item["mime_type"]) for item in media.values()]
+        )
+        uploads = {data: upload for data, upload in zip(media, uploads) if upload[0]}
+        if not uploads:
+            return None, {}
+        # the inline payload is kept untouched as a fallback
+        contents = [
+            {
+                **content,
+                "parts": [
+                    (
+                        {
+                            **{key: val for key, val in part.items() if key != "inline_data"},
+                            "file_data": {
+                                "mime_type": part["inline_data"]["mime_type"],
+                                "file_uri": uploads[part["inline_data"]["data"]][0],
+                            },
+                        }
+                        if "inline_data" in part and part["inline_data"]["data"] in uploads
+                        else part
+                    )
+                    for part in content["parts"]
+                ],
+            }
+            for content in payload["json"]["contents"]
+        ]
+        return {**payload, "json": {**payload["json"], "contents": contents}}, dict(uploads.values())
+
+    async def _upload_media(self, client: httpx.AsyncClient, data: str, mime_type: str) -> Tuple[str, str]:
+        # hashing, decoding and the registry lookups stay off the event loop
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(self.upload_executor, self._media_digest, data)
+        account = hashlib.sha256(f"{self.valves.upload_url}:{self.valves.api_key}".encode()).hexdigest()[:16]
+        registry_key = f"{account}:{digest}"
+        file_uri = await loop.run_in_executor(self.upload_executor, self.file_registry.get, registry_key)
+        if file_uri:
+            return file_uri, registry_key
+        media = await loop.run_in_executor(self.upload_executor, base64.b64decode, data)
+        try:
+            # resumable upload: start a session, then send the bytes and finalize
+            response = await client.post(
+                self.valves.upload_url,
+                headers={
+                    "X-Goog-Upload-Protocol": "resumable",
+                    "X-Goog-Upload-Command": "start",
+                    "X-Goog-Upload-Header-Content-Length": str(len(media)),
+                    "X-Goog-Upload-Header-Content-Type": mime_type,
+                },
+                json={"file": {"display_name": digest[:16]}},
+            )
+            if response.status_code == 200:
+                response = await client.post(
+                    response.headers["x-goog-upload-url"],
+                    headers={"X-Goog-Upload-Offset": "0", "X-Goog-Upload-Command": "upload, finalize"},
+                    content=media,
+                )
+        except (httpx.RequestError, KeyError) as err:
+            logger.warning("upload media failed: %s", err)
+            return "", registry_key
+        if response.status_code != 200:
+            logger.warning("upload media failed with %d: %s", response.status_code, response.text)
+            return "", registry_key
+        file = response.json()["file"]
+        # files expire after 48 hours, forget them an hour earlier
+        ttl = GEMINI_FILE_TTL
+        try:
+            ttl = int(datetime.fromisoformat(file["expirationTime"].replace("Z", "+00:00")).timestamp() - time.time())
+        except (KeyError, ValueError):
+            pass
+        await loop.run_in_executor(
+            self.upload_executor, partial(self.file_registry.set, registry_key, file["uri"], ttl=max(ttl - 3600, 60))
+        )
+        return file["uri"], registry_key
+
+    def _media_digest(self, data: str) -> str:
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def _is_file_error(self, status_code: int, text: str) -> bool:
+        return 400 <= status_code < 500 and "file" in text.lower()
+
+    async def _forget_files(self, file_uris: Dict[str, str], text: str) -> None:
+        # drop the files named in the error, or every file of the request when none is named
+        registry_keys = [
+            registry_key for file_uri, registry_key in file_uris.items() if file_uri.rsplit("/", 1)[-1] in text
+        ] or list(file_uris.values())
+        logger.warning("file reference rejected, resend %d media inline", len(registry_keys))
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *[loop.run_in_executor(self.upload_executor, self.file_registry.delete, key) for key in registry_keys]
+        )
 
     async def _build_payload(self, user: UserModel, body: dict, user_valves: UserValves) -> Tuple[str, dict]:
         # payload
@@ -193,11 +950,9 @@ class Pipe:
                 for item in message_content.split("\n"):
                     if not item:
                         continue
-                    if item.startswith("![gemini-image-"):
-                        file = await self._get_image_content(user, item)
-                        parts.append(
-                            {"inline_data": {"mime_type": "image/png", "data": base64.b64encode(file.read()).decode()}}
-                        )
+                    if item.lstrip("[").startswith("![gemini-image-"):
+                        image_data, mime_type = await self._get_image_content(user, item)
+                        parts.append({"inline_data": {"mime_type": mime_type, "data": image_data}})
                         continue
                     parts.append({"text": message_content})
             # list content
@@ -210,6 +965,7 @@ class Pipe:
                         image_url = content["image_url"]["url"]
                         header, encoded = image_url.split(",", 1)
                         mime_type = header.split(";")[0].split(":")[1]
+                        encoded, mime_type = await self._prepare_reference(encoded, mime_type)
                         parts.append({"inline_data": {"mime_type": mime_type, "data": encoded}})
             else:
                 raise TypeError("message content invalid")
@@ -220,6 +976,7 @@ class Pipe:
             "json": {
                 "contents": [{"parts": parts}],
                 "generationConfig": {
+                    **({"thinkingConfig": {"includeThoughts": True}} if self.valves.include_thoughts else {}),
                     "responseModalities": self.valves.response_modalities.split(","),
                     "imageConfig": {
                         "aspectRatio": user_valves.aspect_ratio,
@@ -235,11 +992,35 @@ class Pipe:
 
         return model, payload
 
+    def _format_status(self, description: str, done: bool) -> str:
+        data = {"event": {"type": "status", "data": {"description": description, "done": done}}}
+        return f"data: {json.dumps(data)}\n\n"
+
+    def _format_usage(self, usage_metadata: dict) -> dict:
+        usage = {
+            "prompt_tokens": usage_metadata.pop("promptTokenCount", 0) if usage_metadata else 0,
+            "completion_tokens": usage_metadata.pop("candidatesTokenCount", 0) if usage_metadata else 0,
+            "total_tokens": usage_metadata.pop("totalTokenCount", 0) if usage_metadata else 0,
+            "prompt_tokens_details": {
+                "cached_tokens": (usage_metadata.get("cachedContentTokenCount", 0) if usage_metadata else 0)
+            },
+            "metadata": usage_metadata or {},
+        }
+        if usage_metadata and "toolUsePromptTokenCount" in usage_metadata:
+            usage["prompt_tokens"] += usage_metadata["toolUsePromptTokenCount"]
+        if usage_metadata and "thoughtsTokenCount" in usage_metadata:
+            usage["completion_tokens"] += usage_metadata["thoughtsTokenCount"]
+        if usage["prompt_tokens"] + usage["completion_tokens"] != usage["total_tokens"]:
+            usage["completion_tokens"] = usage["total_tokens"] - usage["prompt_tokens"]
+        return usage
+
+    # pylint: disable=R0913,R0917
     def _format_data(
         self,
         is_stream: bool,
         model: Optional[str] = "",
         content: Optional[str] = "",
+        reasoning_content: Optional[str] = "",
         usage: Optional[dict] = None,
     ) -> str:
         data = {
@@ -249,12 +1030,13 @@ class Pipe:
             "created": int(time.time()),
             "model": model,
         }
-        if content:
+        if content or reasoning_content:
             data["choices"] = [
                 {
                     "finish_reason": "stop",
                     "index": 0,
                     "delta" if is_stream else "message": {
+                        "reasoning_content": reasoning_content,
                         "content": content,
                     },
                 }
@@ -2,26 +2,41 @@
 title: Grok Responses
 author: OVINC CN
 git_url: https://github.com/OVINC-CN/OpenWebUIPlugin.git
-version: 0.1.0
+version: 0.1.8
 licence: MIT
 """
 
+import asyncio
+import base64
+import hashlib
 import json
 import logging
+import threading
 import time
 import uuid
-from typing import AsyncIterable, Optional, Tuple
+from collections import OrderedDict
+from functools import partial
+from typing import AsyncIterable, Dict, Literal, Optional, Set, Tuple
 
 import httpx
 from fastapi import Request
 from httpx import Response
-from open_webui.env import GLOBAL_LOG_LEVEL
+from open_webui.env import (
+    GLOBAL_LOG_LEVEL,
+    REDIS_SENTINEL_HOSTS,
+    REDIS_SENTINEL_PORT,
+    REDIS_URL,
+)
+from open_webui.utils.redis import get_redis_connection, get_sentinels_from_env
 from pydantic import BaseModel, Field
 from starlette.responses import StreamingResponse
 
 logger = logging.getLogger(__name__)
 logger.setLevel(GLOBAL_LOG_LEVEL)
 
+TERMINAL_EVENTS = {"response.completed", "response.failed", "response.incomplete", "error"}
+DISCONNECT_CHECK_INTERVAL = 1
+
 
 class APIException(Exception):
     def __init__(self, status: int, content: str, response: Response):
@@ -43,6 +58,72 @@ class APIException(Exception):
         return "Unknown API error"
 
 
+class ClientDisconnectedError(Exception):
+    pass
+
+
+class StreamStalledError(Exception):
+    pass
+
+
+class FileIndex:
+    def __init__(self, prefix: str, max_items: int = 10000):
+        self.prefix = prefix
+        self.max_items = max_items
+        self._items: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = get_redis_connection(
+            redis_url=REDIS_URL,
+            redis_sentinels=get_sentinels_from_env(REDIS_SENTINEL_HOSTS, REDIS_SENTINEL_PORT),
+            decode_responses=True,
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        key = f"{self.prefix}:{key}"
+        # shared index
+        if self._redis is not None:
+            try:
+                return self._redis.get(key)
+            except Exception as err:
+                logger.warning("[FileIndex] redis get failed: %s", err)
+        # local index
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[1] < time.time():
+                self._items.pop(key, None)
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        key = f"{self.prefix}:{key}"
+        # shared index
+        if self._redis is not None:
+            try:
+                self._redis.set(key, value, ex=ttl)
+                return
+            except Exception as err:
+                logger.warning("[FileIndex] redis set failed: %s", err)
+        # local index
+        with self._lock:
+            self._items[key] = (value, time.time() + ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        key = f"{self.prefix}:{key}"
+        if self._redis is not None:
+            try:
+                self._redis.delete(key)
+            except Exception as err:
+                logger.warning("[FileIndex] redis delete failed: %s", err)
+        with self._lock:
+            self._items.pop(key, None)
+
+
 class Pipe:
     class Valves(BaseModel):
         base_url: str = Field(default="https://api.x.ai/v1", title="Base URL")
@@ -52,91 +133,448 @@ class Pipe:
             default="", title="透传参数", description="允许配置的参数，使用英文逗号分隔，例如 temperature"
         )
         timeout: int = Field(default=600, title="请求超时时间（秒）")
+        total_timeout: int = Field(
+            default=0, title="请求总超时时间（秒）", description="单次流式请求的最长时间，0 表示不限制", ge=0
+        )
+        connect_timeout: int = Field(default=10, title="连接超时时间（秒）", ge=1)
+        first_byte_timeout: int = Field(
+            default=600,
+            title="首字超时时间（秒）",
+            description="发出请求到收到第一段数据的最长等待时间，默认与请求超时一致，推理模型不宜调低",
+            ge=1,
+        )
+        idle_timeout: int = Field(
+            default=600,
+            title="流式空闲超时时间（秒）",
+            description="两段数据之间的最长间隔，超时后中止请求，默认与请求超时一致",
+            ge=1,
+        )
+        model_timeouts: str = Field(
+            default="",
+            title="模型超时配置",
+            description="使用英文逗号分隔多个模型，使用/分隔模型、首字超时和空闲超时，例如 grok-4/120/900",
+        )
         proxy: Optional[str] = Field(default="", title="代理地址")
         models: str = Field(default="grok-4.20-beta", title="模型", description="使用英文逗号分隔多个模型")
+        enable_file_upload: bool = Field(
+            default=False, title="图片上传到文件接口", description="较大的图片只上传一次，后续轮次通过 file_id 引用"
+        )
+        file_upload_min_size: int = Field(default=64, title="上传图片最小大小 (KB)", ge=0)
+        file_cache_ttl: int = Field(default=30, title="文件缓存有效期 (天)", ge=1, le=30)
+        prompt_cache_scope: Literal["none", "chat", "user"] = Field(
+            default="chat", title="提示词缓存范围", description="按对话或用户生成缓存路由键，提高缓存命中率"
+        )
+        enable_background: bool = Field(
+            default=False, title="后台模式", description="在服务端后台生成，连接中断后从断点继续接收"
+        )
+        background_timeout: int = Field(default=3600, title="后台任务超时时间（秒）")
+        background_poll_interval: int = Field(default=2, title="后台任务重连间隔（秒）")
+        abort_on_disconnect: bool = Field(
+            default=False,
+            title="客户端断开时中止请求",
+            description="OpenWebUI 在后台消费响应时请求会提前结束，确认部署方式后再开启",
+        )
 
     class UserValves(BaseModel):
         pass
 
     def __init__(self):
         self.valves = self.Valves()
+        self.file_index = FileIndex(prefix="grok_responses:file")
+        self.cancel_requests: Set[asyncio.Task] = set()
 
     def pipes(self):
         return [{"id": model, "name": model} for model in self.valves.models.split(",") if model]
 
-    async def pipe(self, body: dict, __user__: dict, __request__: Request) -> StreamingResponse:
-        return StreamingResponse(self.__stream_pipe(body=body, __user__=__user__, __request__=__request__))
+    async def pipe(
+        self, body: dict, __user__: dict, __request__: Request, __metadata__: Optional[dict] = None
+    ) -> StreamingResponse:
+        return StreamingResponse(
+            self.__stream_pipe(body=body, __user__=__user__, __request__=__request__, __metadata__=__metadata__ or {})
+        )
 
-    async def __stream_pipe(self, body: dict, __user__: dict, __request__: Request) -> AsyncIterable:
-        model, payload = await self._build_payload(body=body, user_valves=__user__["valves"])
+    async def __stream_pipe(
+        self, body: dict, __user__: dict, __request__: Request, __metadata__: dict
+    ) -> AsyncIterable:
+        model, payload = await self._build_payload(
+            body=body, user_valves=__user__["valves"], cache_key=self._cache_key(__user__, __metadata__)
+        )
         # call client
         async with httpx.AsyncClient(
             base_url=self.valves.base_url,
             headers={"Authorization": f"Bearer {self.valves.api_key}"},
             proxy=self.valves.proxy or None,
             trust_env=True,
-            timeout=self.valves.timeout,
+            timeout=self._http_timeout(model),
         ) as client:
-            async with client.stream(**payload) as response:
-                if response.status_code != 200:
-                    text = ""
-                    async for line in response.aiter_lines():
-                        text += line  # pylint: disable=R1713
-                    logger.error("response invalid with %d: %s", response.status_code, text)
-                    raise APIException(status=response.status_code, content=text, response=response)
-                is_thinking = self.valves.enable_reasoning
-                async for line in response.aiter_lines():
-                    line = line.strip()
-                    if not line:
-                        continue
-                    if line.startswith("event:") or not line.startswith("data:"):
-                        continue
-                    if line.startswith("data: "):
-                        line = line[6:]
-                    if isinstance(line, str):
-                        line = json.loads(line)
-                    match line.get("type"):
-                        case "response.reasoning_summary_text.delta":
-                            if is_thinking:
-                                yield self._format_stream_data(model=model, reasoning_content=line["delta"])
-                        case "response.output_text.delta":
-                            if is_thinking:
-                                is_thinking = False
-                            yield self._format_stream_data(model=model, content=line["delta"])
-                        case "response.completed":
-                            usage_metadata = line["response"].get("usage") or {}
-                            usage = {
-                                "prompt_tokens": usage_metadata.pop("input_tokens", 0) if usage_metadata else 0,
-                                "completion_tokens": usage_metadata.pop("output_tokens", 0) if usage_metadata else 0,
-                                "total_tokens": usage_metadata.pop("total_tokens", 0) if usage_metadata else 0,
-                                "prompt_tokens_details": (
-                                    usage_metadata.pop("input_tokens_details") or {} if usage_metadata else {}
-                                ),
-                                "metadata": usage_metadata or {},
-                            }
-                            if usage["prompt_tokens_details"]:
-                                cached_tokens = usage["prompt_tokens_details"].get("cached_tokens") or 0
-                                if cached_tokens > usage["prompt_tokens"]:
-                                    usage["prompt_tokens"] = cached_tokens
-                                    usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
-                            yield self._format_stream_data(model=model, usage=usage, if_finished=True)
-                        case _:
-                            event_type = line["type"]
-                            if event_type.endswith("in_progress") or event_type.endswith("completed"):
-                                event_type_split = event_type.split(".")[1:]
-                                if len(event_type_split) == 2:
-                                    data = {
-                                        "event": {
-                                            "type": "status",
-                                            "data": {
-                                                "description": " ".join(event_type_split),
-                                                "done": event_type_split[1] == "completed",
-                                            },
-                                        }
+            offloaded, file_ids = (
+                await self._offload_images(client, payload) if self.valves.enable_file_upload else (None, {})
+            )
+            for request_payload in [offloaded, payload] if offloaded else [payload]:
+                started = time.time()
+                async with client.stream(**request_payload) as response:
+                    if response.status_code != 200:
+                        text = ""
+                        async for line in response.aiter_lines():
+                            text += line  # pylint: disable=R1713
+                        logger.error("response invalid with %d: %s", response.status_code, text)
+                        # a referenced file may be gone, forget it and resend the images inline
+                        if request_payload is offloaded and self._is_file_error(response.status_code, text):
+                            await self._forget_files(file_ids, text)
+                            continue
+                        raise APIException(status=response.status_code, content=text, response=response)
+                    is_thinking = self.valves.enable_reasoning
+                    response_id, output_chars, finished = "", 0, False
+                    checked_at = time.time()
+                    try:
+                        async for line in self._iter_events(client, response, model, started):
+                            if time.time() - checked_at >= DISCONNECT_CHECK_INTERVAL:
+                                checked_at = time.time()
+                                await self._check_disconnected(__request__)
+                            response_id = (line.get("response") or {}).get("id") or response_id
+                            finished = finished or line.get("type") in TERMINAL_EVENTS
+                            match line.get("type"):
+                                case "response.reasoning_summary_text.delta":
+                                    output_chars += len(line["delta"])
+                                    if is_thinking:
+                                        yield self._format_stream_data(model=model, reasoning_content=line["delta"])
+                                case "response.output_text.delta":
+                                    if is_thinking:
+                                        is_thinking = False
+                                    output_chars += len(line["delta"])
+                                    yield self._format_stream_data(model=model, content=line["delta"])
+                                case "response.completed":
+                                    usage_metadata = line["response"].get("usage") or {}
+                                    usage = {
+                                        "prompt_tokens": usage_metadata.pop("input_tokens", 0) if usage_metadata else 0,
+                                        "completion_tokens": (
+                                            usage_metadata.pop("output_tokens", 0) if usage_metadata else 0
+                                        ),
+                                        "total_tokens": usage_metadata.pop("total_tokens", 0) if usage_metadata else 0,
+                                        "prompt_tokens_details": (
+                                            usage_metadata.pop("input_tokens_details") or {} if usage_metadata else {}
+                                        ),
+                                        "metadata": usage_metadata or {},
                                     }
-                                    yield f"data: {json.dumps(data)}\n\n"
+                                    if usage["prompt_tokens_details"]:
+                                        cached_tokens = usage["prompt_tokens_details"].get("cached_tokens") or 0
+                                        if cached_tokens > usage["prompt_tokens"]:
+                                            usage["prompt_tokens"] = cached_tokens
+                                            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+                                    self._report_cache(
+                                        usage,
+                                        usage["prompt_tokens"],
+                                        usage["prompt_tokens_details"].get("cached_tokens") or 0,
+                                    )
+                                    yield self._format_stream_data(model=model, usage=usage, if_finished=True)
+                                case _:
+                                    event_type = line["type"]
+                                    if event_type.endswith("in_progress") or event_type.endswith("completed"):
+                                        event_type_split = event_type.split(".")[1:]
+                                        if len(event_type_split) == 2:
+                                            data = {
+                                                "event": {
+                                                    "type": "status",
+                                                    "data": {
+                                                        "description": " ".join(event_type_split),
+                                                        "done": event_type_split[1] == "completed",
+                                                    },
+                                                }
+                                            }
+                                            yield f"data: {json.dumps(data)}\n\n"
+                    except ClientDisconnectedError:
+                        # leaving the stream context closes the upstream connection
+                        if not finished:
+                            usage = self._partial_usage(output_chars)
+                            logger.info("client disconnected, abort %s with usage %s", response_id, json.dumps(usage))
+                            self._abort_response(response_id)
+                            yield self._format_stream_data(model=model, usage=usage, if_finished=True)
+                    except StreamStalledError as err:
+                        logger.warning("stream of %s stalled: %s", response_id or model, err)
+                        yield self._format_stalled(err)
+                        if response_id and not finished:
+                            self._abort_response(response_id)
+                            yield self._format_stream_data(
+                                model=model, usage=self._partial_usage(output_chars), if_finished=True
+                            )
+                    except (asyncio.CancelledError, GeneratorExit):
+                        # stopped from the ui, the upstream connection is closed while unwinding
+                        if not finished:
+                            usage = self._partial_usage(output_chars)
+                            logger.info("generation stopped, abort %s with usage %s", response_id, json.dumps(usage))
+                            self._abort_response(response_id)
+                        raise
+                break
+
+    async def _watch_lines(self, response: Response, model: str, started: float) -> AsyncIterable[str]:
+        # httpx only bounds single reads, abort when the first chunk, the next chunk or the whole response is late
+        first_byte_timeout, idle_timeout = self._stream_timeouts(model)
+        deadline = started + self.valves.total_timeout if self.valves.total_timeout > 0 else float("inf")
+        lines = response.aiter_lines()
+        wait_until, reason = started + first_byte_timeout, f"no response within {first_byte_timeout}s"
+        while True:
+            if deadline < wait_until:
+                wait_until, reason = deadline, f"response exceeded {self.valves.total_timeout}s"
+            try:
+                line = await asyncio.wait_for(anext(lines), timeout=max(wait_until - time.time(), 0))
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError as err:
+                raise StreamStalledError(reason) from err
+            yield line
+            wait_until, reason = time.time() + idle_timeout, f"no data for {idle_timeout}s"
+
+    def _stream_timeouts(self, model: str) -> Tuple[int, int]:
+        # thinking models may stay silent for a long time, so they get their own budgets
+        for item in self.valves.model_timeouts.split(","):
+            parts = [part.strip() for part in item.split("/")]
+            if len(parts) == 3 and parts[0] == model and parts[1].isdigit() and parts[2].isdigit():
+                return int(parts[1]), int(parts[2])
+        return self.valves.first_byte_timeout, self.valves.idle_timeout
+
+    def _http_timeout(self, model: str = "") -> httpx.Timeout:
+        # the request timeout still bounds every single read, unless a stream budget is longer
+        first_byte_timeout, idle_timeout = self._stream_timeouts(model)
+        return httpx.Timeout(
+            max(self.valves.timeout, first_byte_timeout, idle_timeout),
+            connect=self.valves.connect_timeout,
+            pool=self.valves.connect_timeout,
+        )
 
-    async def _build_payload(self, body: dict, user_valves: UserValves, stream: bool = True) -> Tuple[str, dict]:
+    def _format_stalled(self, err: StreamStalledError) -> str:
+        data = {"event": {"type": "status", "data": {"description": f"{err}, request aborted", "done": True}}}
+        return f"data: {json.dumps(data)}\n\n"
+
+    async def _check_disconnected(self, __request__: Request) -> None:
+        if self.valves.abort_on_disconnect and await __request__.is_disconnected():
+            raise ClientDisconnectedError()
+
+    def _partial_usage(self, output_chars: int) -> dict:
+        # usage is only reported on completion, estimate the streamed output and leave the input unknown
+        completion_tokens = (output_chars + 3) // 4
+        return {
+            "prompt_tokens": 0,
+            "completion_tokens": completion_tokens,
+            "total_tokens": completion_tokens,
+            "metadata": {"partial": True, "estimated_completion_tokens": True},
+        }
+
+    def _abort_response(self, response_id: str) -> None:
+        # closing the stream stops a foreground response, a background one keeps running upstream
+        if not (self.valves.enable_background and response_id):
+            return
+        # the generator may be closing, so do not await here
+        cancel_request = asyncio.create_task(self._cancel_response(response_id))
+        self.cancel_requests.add(cancel_request)
+        cancel_request.add_done_callback(self.cancel_requests.discard)
+
+    async def _cancel_response(self, response_id: str) -> None:
+        try:
+            async with httpx.AsyncClient(
+                base_url=self.valves.base_url,
+                headers={"Authorization": f"Bearer {self.valves.api_key}"},
+                proxy=self.valves.proxy or None,
+                trust_env=True,
+                timeout=self._http_timeout(),
+            ) as client:
+                response = await client.post(f"/responses/{response_id}/cancel")
+        except httpx.HTTPError as err:
+            logger.warning("cancel response %s failed: %s", response_id, err)
+            return
+        if response.status_code != 200:
+            logger.warning("cancel response %s failed with %d: %s", response_id, response.status_code, response.text)
+
+    async def _offload_images(self, client: httpx.AsyncClient, payload: dict) -> Tuple[Optional[dict], Dict[str, str]]:
+        images = [
+            item
+            for message in payload["json"]["input"]
+            if isinstance(message.get("content"), list)
+            for item in message["content"]
+            if item.get("type") == "input_image"
+            and item.get("image_url", "").startswith("data:")
+            and len(item["image_url"]) >= self.valves.file_upload_min_size * 1024
+        ]
+        if not images:
+            return None, {}
+        # upload new images once, reference every image by file id
+        image_urls = list({item["image_url"] for item in images})
+        uploads = await asyncio.gather(*[self._upload_file(client, image_url) for image_url in image_urls])
+        uploads = {image_url: upload for image_url, upload in zip(image_urls, uploads) if upload[0]}
+        if not uploads:
+            return None, {}
+        # the inline payload is kept untouched as a fallback
+        messages = [
+            (
+                {
+                    **message,
+                    "content": [
+                        (
+                            {
+                                **{key: val for key, val in item.items() if key != "image_url"},
+                                "file_id": uploads[item["image_url"]][0],
+                            }
+                            if item.get("type") == "input_image" and item.get("image_url") in uploads
+                            else item
+                        )
+                        for item in message["content"]
+                    ],
+                }
+                if isinstance(message.get("content"), list)
+                else message
+            )
+            for message in payload["json"]["input"]
+        ]
+        return {**payload, "json": {**payload["json"], "input": messages}}, dict(uploads.values())
+
+    async def _upload_file(self, client: httpx.AsyncClient, image_url: str) -> Tuple[str, str]:
+        header, data = image_url.split(",", 1)
+        mime_type = header.split(";")[0].split(":")[1]
+        digest = hashlib.sha256(data.encode()).hexdigest()
+        account = hashlib.sha256(f"{self.valves.base_url}:{self.valves.api_key}".encode()).hexdigest()[:16]
+        cache_key = f"{account}:{digest}"
+        loop = asyncio.get_running_loop()
+        file_id = await loop.run_in_executor(None, self.file_index.get, cache_key)
+        if file_id:
+            return file_id, cache_key
+        ttl = self.valves.file_cache_ttl * 86400
+        try:
+            response = await client.post(
+                "/files",
+                data={"purpose": "vision"},
+                files={"file": (f"{digest[:16]}.{mime_type.split('/')[-1]}", base64.b64decode(data), mime_type)},
+            )
+        except httpx.RequestError as err:
+            logger.warning("upload image failed: %s", err)
+            return "", cache_key
+        if response.status_code != 200:
+            logger.warning("upload image failed with %d: %s", response.status_code, response.text)
+            return "", cache_key
+        file_id = response.json()["id"]
+        # forget the file an hour before the provider may drop it
+        await loop.run_in_executor(None, partial(self.file_index.set, cache_key, file_id, ttl=max(ttl - 3600, 60)))
+        return file_id, cache_key
+
+    def _is_file_error(self, status_code: int, text: str) -> bool:
+        return 400 <= status_code < 500 and "file" in text.lower()
+
+    async def _forget_files(self, file_ids: Dict[str, str], text: str) -> None:
+        # drop the files named in the error, or every file of the request when none is named
+        cache_keys = [cache_key for file_id, cache_key in file_ids.items() if file_id in text] or list(
+            file_ids.values()
+        )
+        logger.warning("file reference rejected, resend %d image(s) inline", len(cache_keys))
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(None, self.file_index.delete, key) for key in cache_keys])
+
+    async def _iter_events(
+        self, client: httpx.AsyncClient, response: Response, model: str, started: float
+    ) -> AsyncIterable[dict]:
+        response_id, sequence_number, output_length = "", None, 0
+        try:
+            async for event in self._parse_events(response, model, started):
+                response_id = (event.get("response") or {}).get("id") or response_id
+                sequence_number = event.get("sequence_number", sequence_number)
+                if event.get("type") == "response.output_text.delta":
+                    output_length += len(event["delta"])
+                yield event
+                if event.get("type") in TERMINAL_EVENTS:
+                    return
+        except (httpx.RequestError, StreamStalledError) as err:
+            if not (self.valves.enable_background and response_id):
+                raise
+            logger.warning("stream of %s interrupted after %s: %s", response_id, sequence_number, err)
+        if not (self.valves.enable_background and response_id):
+            return
+        # the response keeps running upstream, pick it up where the stream stopped
+        async for event in self._resume_events(client, model, response_id, sequence_number, output_length):
+            yield event
+
+    async def _resume_events(
+        self,
+        client: httpx.AsyncClient,
+        model: str,
+        response_id: str,
+        sequence_number: Optional[int],
+        output_length: int,
+    ) -> AsyncIterable[dict]:
+        deadline = time.time() + self.valves.background_timeout
+        while time.time() < deadline:
+            await asyncio.sleep(self.valves.background_poll_interval)
+            params = {"stream": "true"}
+            if sequence_number is not None:
+                params["starting_after"] = sequence_number
+            try:
+                started = time.time()
+                async with client.stream("GET", f"/responses/{response_id}", params=params) as response:
+                    if response.status_code != 200:
+                        logger.warning(
+                            "resume %s failed with %d: %s",
+                            response_id,
+                            response.status_code,
+                            (await response.aread()).decode(errors="replace"),
+                        )
+                        break
+                    async for event in self._parse_events(response, model, started):
+                        sequence_number = event.get("sequence_number", sequence_number)
+                        if event.get("type") == "response.output_text.delta":
+                            output_length += len(event["delta"])
+                        yield event
+                        if event.get("type") in TERMINAL_EVENTS:
+                            return
+            except (httpx.RequestError, StreamStalledError) as err:
+                logger.warning("stream of %s interrupted after %s: %s", response_id, sequence_number, err)
+        # streaming is not available, wait for the final state instead
+        while time.time() < deadline:
+            response = await client.get(f"/responses/{response_id}")
+            if response.status_code != 200:
+                logger.error("response invalid with %d: %s", response.status_code, response.text)
+                raise APIException(status=response.status_code, content=response.text, response=response)
+            data = response.json()
+            if data.get("status") in ("queued", "in_progress"):
+                await asyncio.sleep(self.valves.background_poll_interval)
+                continue
+            if data.get("status") != "completed":
+                raise APIException(status=response.status_code, content=response.text, response=response)
+            output_text = "".join(
+                content.get("text", "")
+                for item in data.get("output") or []
+                if item.get("type") == "message"
+                for content in item.get("content") or []
+                if content.get("type") == "output_text"
+            )
+            if output_text[output_length:]:
+                yield {"type": "response.output_text.delta", "delta": output_text[output_length:]}
+            yield {"type": "response.completed", "response": data}
+            return
+        raise TimeoutError(f"response {response_id} timeout")
+
+    async def _parse_events(self, response: Response, model: str, started: float) -> AsyncIterable[dict]:
+        async for line in self._watch_lines(response, model, started):
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("event:") or not line.startswith("data:"):
+                continue
+            if line.startswith("data: "):
+                line = line[6:]
+            yield json.loads(line)
+
+    def _cache_key(self, __user__: dict, __metadata__: dict) -> str:
+        # route turns of the same chat, or of the same user, to the same prompt cache
+        if self.valves.prompt_cache_scope == "none":
+            return ""
+        scope_id = __user__["id"]
+        if self.valves.prompt_cache_scope == "chat" and __metadata__.get("chat_id"):
+            scope_id = __metadata__["chat_id"]
+        return hashlib.sha256(f"{self.valves.prompt_cache_scope}:{scope_id}".encode()).hexdigest()[:32]
+
+    def _report_cache(self, usage: dict, input_tokens: int, cached_tokens: int) -> None:
+        usage["cache_hit_ratio"] = round(cached_tokens / input_tokens, 4) if input_tokens else 0
+        logger.info("prompt cache hit %d/%d (%.2f%%)", cached_tokens, input_tokens, usage["cache_hit_ratio"] * 100)
+
+    async def _build_payload(
+        self, body: dict, user_valves: UserValves, stream: bool = True, cache_key: str = ""
+    ) -> Tuple[str, dict]:
         model = body["model"].split(".", 1)[1]
 
         # build messages
@@ -167,7 +605,7 @@ class Pipe:
             "model": model,
             "input": messages,
             "stream": stream,
-            "store": False,
+            "store": self.valves.enable_background,
         }
 
         # other parameters
@@ -175,7 +613,13 @@ class Pipe:
         for key, val in body.items():
             if key in allowed_params:
                 data[key] = val
+
+        # generate in the background so the stream can be resumed
+        if self.valves.enable_background:
+            data["background"] = True
         payload = {"method": "POST", "url": "/responses", "json": data}
+        if cache_key:
+            payload["headers"] = {"x-grok-conv-id": cache_key}
 
         # check tools
         if body.get("tools", []):
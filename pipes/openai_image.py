@@ -2,24 +2,40 @@
 title: OpenAI Image
 author: OVINC CN
 git_url: https://github.com/OVINC-CN/OpenWebUIPlugin.git
-version: 0.0.9
+version: 0.0.21
 licence: MIT
 """
 
+import asyncio
 import base64
+import binascii
+import hashlib
 import io
 import json
 import logging
+import threading
 import time
 import uuid
-from typing import AsyncIterable, List, Literal, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from tempfile import SpooledTemporaryFile
+from typing import AsyncIterable, BinaryIO, List, Literal, Optional, Set, Tuple, Union
 
 import httpx
 from fastapi import BackgroundTasks, Request, UploadFile
 from httpx import Response
-from open_webui.env import GLOBAL_LOG_LEVEL
+from open_webui.env import (
+    GLOBAL_LOG_LEVEL,
+    REDIS_SENTINEL_HOSTS,
+    REDIS_SENTINEL_PORT,
+    REDIS_URL,
+)
+from open_webui.models.files import Files
 from open_webui.models.users import UserModel, Users
 from open_webui.routers.files import get_file_content_by_id, upload_file
+from open_webui.utils.redis import get_redis_connection, get_sentinels_from_env
+from PIL import Image, ImageOps
 from pydantic import BaseModel, Field
 from starlette.datastructures import Headers
 from starlette.responses import StreamingResponse
@@ -27,6 +43,11 @@ from starlette.responses import StreamingResponse
 logger = logging.getLogger(__name__)
 logger.setLevel(GLOBAL_LOG_LEVEL)
 
+UPLOAD_MAX_WORKERS = 4
+SPOOL_MAX_SIZE = 1024 * 1024
+BASE64_FILE_PLACEHOLDER = "__base64_file_"
+PREVIEW_MAX_SIZE = 512
+
 
 class APIException(Exception):
     def __init__(self, status: int, content: str, response: Response):
@@ -48,12 +69,235 @@ class APIException(Exception):
         return "Unknown API error"
 
 
+class Base64FieldExtractor:
+    def __init__(self, fields: Set[str], max_memory: int = SPOOL_MAX_SIZE):
+        self.fields = {field.encode() for field in fields}
+        self.max_memory = max_memory
+        self.files: List[SpooledTemporaryFile] = []
+        self._skeleton = bytearray()
+        self._string = bytearray()
+        self._in_string = False
+        self._escape = False
+        self._last_string: Optional[bytes] = None
+        self._pending_key: Optional[bytes] = None
+        self._capture: Optional[SpooledTemporaryFile] = None
+        self._capture_escape = False
+        self._rest = b""
+
+    def feed(self, chunk: bytes) -> None:
+        index = 0
+        length = len(chunk)
+        while index < length:
+            # base64 value, decoded straight into a spooled file
+            if self._capture is not None:
+                if self._capture_escape:
+                    self._capture_escape = False
+                    if chunk[index] == ord("/"):
+                        self._write(b"/")
+                    index += 1
+                    continue
+                quote = chunk.find(b'"', index)
+                escape = chunk.find(b"\\", index, quote if quote >= 0 else length)
+                stop = escape if escape >= 0 else (quote if quote >= 0 else length)
+                self._write(chunk[index:stop])
+                if stop == length:
+                    return
+                if stop == escape:
+                    self._capture_escape = True
+                else:
+                    self._finish()
+                index = stop + 1
+                continue
+            # regular json
+            char = chunk[index]
+            if self._in_string:
+                self._skeleton.append(char)
+                if self._escape:
+                    self._escape = False
+                    self._string.append(char)
+                elif char == ord("\\"):
+                    self._escape = True
+                elif char == ord('"'):
+                    self._in_string = False
+                    self._last_string = bytes(self._string)
+                else:
+                    self._string.append(char)
+            elif char == ord('"'):
+                if self._pending_key in self.fields:
+                    self._capture = SpooledTemporaryFile(max_size=self.max_memory)
+                    self._rest = b""
+                else:
+                    self._skeleton.append(char)
+                    self._in_string = True
+                    self._string.clear()
+                self._pending_key = None
+            else:
+                self._skeleton.append(char)
+                if char == ord(":"):
+                    self._pending_key = self._last_string
+                    self._last_string = None
+                elif char not in b" \t\r\n":
+                    # whitespace may sit between a key and its colon
+                    self._pending_key = None
+                    self._last_string = None
+            index += 1
+
+    def result(self) -> dict:
+        return json.loads(bytes(self._skeleton))
+
+    def file(self, value: str) -> SpooledTemporaryFile:
+        image_file = self.files[int(value[len(BASE64_FILE_PLACEHOLDER) :])]
+        image_file.seek(0)
+        return image_file
+
+    def close(self) -> None:
+        if self._capture is not None:
+            self._capture.close()
+        for image_file in self.files:
+            image_file.close()
+
+    def _write(self, data: bytes) -> None:
+        data = self._rest + data
+        usable = len(data) - len(data) % 4
+        self._rest = data[usable:]
+        if usable:
+            self._capture.write(binascii.a2b_base64(data[:usable]))
+
+    def _finish(self) -> None:
+        if self._rest:
+            self._capture.write(binascii.a2b_base64(self._rest + b"=" * (-len(self._rest) % 4)))
+        self._skeleton.extend(f'"{BASE64_FILE_PLACEHOLDER}{len(self.files)}"'.encode())
+        self.files.append(self._capture)
+        self._capture = None
+        self._rest = b""
+
+
+class ImageCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: OrderedDict[str, dict] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item["data"], item["mime_type"]
+
+    def get_base64(self, key: str) -> Optional[Tuple[str, str]]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            # encode lazily and keep the result for later turns
+            if item["base64"] is None:
+                item["base64"] = base64.b64encode(item["data"]).decode()
+                self._size += len(item["base64"])
+                self._evict()
+            return item["base64"], item["mime_type"]
+
+    def set(self, key: str, data: bytes, mime_type: str) -> None:
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._items[key] = {"data": data, "mime_type": mime_type, "base64": None}
+            self._size += len(data)
+            self._evict()
+
+    def _remove(self, key: str) -> None:
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._size -= len(item["data"]) + len(item["base64"] or "")
+
+    def _evict(self) -> None:
+        while self._size > self.max_bytes and len(self._items) > 1:
+            self._remove(next(iter(self._items)))
+
+
+class ImageIndex:
+    def __init__(self, prefix: str, max_items: int = 10000):
+        self.prefix = prefix
+        self.max_items = max_items
+        self._items: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = get_redis_connection(
+            redis_url=REDIS_URL,
+            redis_sentinels=get_sentinels_from_env(REDIS_SENTINEL_HOSTS, REDIS_SENTINEL_PORT),
+            decode_responses=True,
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        key = f"{self.prefix}:{key}"
+        # shared index
+        if self._redis is not None:
+            try:
+                return self._redis.get(key)
+            except Exception as err:
+                logger.warning("[ImageIndex] redis get failed: %s", err)
+        # local index
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            if item[1] < time.time():
+                self._items.pop(key, None)
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        key = f"{self.prefix}:{key}"
+        # shared index
+        if self._redis is not None:
+            try:
+                self._redis.set(key, value, ex=ttl)
+                return
+            except Exception as err:
+                logger.warning("[ImageIndex] redis set failed: %s", err)
+        # local index
+        with self._lock:
+            self._items[key] = (value, time.time() + ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+
 class Pipe:
     class Valves(BaseModel):
         base_url: str = Field(default="https://api.openai.com/v1", title="Base URL")
         api_key: str = Field(default="", title="API Key")
         num_of_images: int = Field(default=1, title="图片数量", ge=1, le=10)
+        partial_images: int = Field(
+            default=0, title="预览图数量", ge=0, le=3, description="大于0时使用流式生成并展示中间预览图"
+        )
         timeout: int = Field(default=600, title="请求超时（秒）")
+        connect_timeout: int = Field(default=10, title="连接超时时间（秒）", ge=1)
+        image_cache_size: int = Field(default=256, title="参考图缓存大小 (MB)", ge=0)
+        reference_max_size: int = Field(
+            default=1536, title="参考图最大边长 (像素)", ge=0, description="上传前缩放用户参考图，0 表示不处理"
+        )
+        reference_format: Literal["webp", "jpeg"] = Field(default="webp", title="参考图编码格式")
+        reference_quality: int = Field(default=85, title="参考图编码质量", ge=1, le=100)
+        output_format: Literal["original", "webp", "avif"] = Field(
+            default="original",
+            title="生成图片存储格式",
+            description="AVIF 需要 Pillow 支持，不支持时使用 WebP；部分服务商不接受 AVIF 作为编辑参考图",
+        )
+        output_quality: int = Field(default=90, title="生成图片编码质量", ge=1, le=100)
+        thumbnail_size: int = Field(default=0, title="缩略图最大边长 (像素)", ge=0, description="0 表示不生成缩略图")
+        enable_dedupe: bool = Field(default=True, title="相同图片复用已存储文件")
+        enable_result_cache: bool = Field(
+            default=False,
+            title="缓存生成结果",
+            description="相同用户使用相同模型、提示词、参数和参考图时直接返回已生成的图片",
+        )
+        result_cache_ttl: int = Field(default=24, title="结果缓存有效期 (小时)", ge=1)
+        dedupe_ttl: int = Field(default=30, title="去重索引有效期 (天)", ge=1)
         proxy: str = Field(default="", title="代理地址")
         models: str = Field(default="gpt-image-1", title="支持模型列表", description="多个模型用逗号分隔")
 
@@ -63,6 +307,13 @@ class Pipe:
 
     def __init__(self):
         self.valves = self.Valves()
+        self.upload_executor = ThreadPoolExecutor(
+            max_workers=UPLOAD_MAX_WORKERS, thread_name_prefix="openai-image-upload"
+        )
+        self.image_cache = ImageCache(max_bytes=self.valves.image_cache_size * 1024 * 1024)
+        self.reference_cache = ImageCache(max_bytes=self.valves.image_cache_size * 1024 * 1024)
+        self.image_index = ImageIndex(prefix="openai_image:dedupe")
+        self.result_cache = ImageIndex(prefix="openai_image:result")
 
     def pipes(self) -> List[dict]:
         return [{"id": m.strip(), "name": m.strip()} for m in self.valves.models.split(",") if m.strip()]
@@ -77,63 +328,377 @@ class Pipe:
 
     async def _pipe(self, body: dict, __user__: dict, __request__: Request) -> AsyncIterable:
         user = Users.get_user_by_id(__user__["id"])
+        self.image_cache.max_bytes = self.valves.image_cache_size * 1024 * 1024
+        self.reference_cache.max_bytes = self.valves.image_cache_size * 1024 * 1024
         model, payload = await self._build_payload(user=user, body=body, user_valves=__user__["valves"])
-        # call client
-        async with httpx.AsyncClient(
-            base_url=self.valves.base_url,
-            headers={"Authorization": f"Bearer {self.valves.api_key}"},
-            proxy=self.valves.proxy or None,
-            trust_env=True,
-            timeout=self.valves.timeout,
-        ) as client:
-            response = await client.post(**payload)
-            if response.status_code != 200:
-                raise APIException(status=response.status_code, content=response.text, response=response)
-            response = response.json()
-
-            # upload image
-            results = []
-            for item in response["data"]:
-                results.append(
-                    self._upload_image(
+        # cached result
+        cache_key = self._result_cache_key(user=user, payload=payload) if self.valves.enable_result_cache else ""
+        loop = asyncio.get_running_loop()
+        results = (
+            await loop.run_in_executor(self.upload_executor, self._get_cached_result, cache_key) if cache_key else None
+        )
+        usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "metadata": {"cached": True}}
+        if results is None:
+            # call client
+            async with httpx.AsyncClient(
+                base_url=self.valves.base_url,
+                headers={"Authorization": f"Bearer {self.valves.api_key}"},
+                proxy=self.valves.proxy or None,
+                trust_env=True,
+                timeout=httpx.Timeout(
+                    self.valves.timeout, connect=self.valves.connect_timeout, pool=self.valves.connect_timeout
+                ),
+            ) as client:
+                if self.valves.partial_images > 0:
+                    results = []
+                    usage = {}
+                    async for item in self._stream_images(
+                        client=client,
+                        payload=payload,
                         __request__=__request__,
                         user=user,
-                        image_data=item["b64_json"],
-                        mime_type="image/png",
-                    )
+                        is_stream=bool(body.get("stream")),
+                    ):
+                        # preview events
+                        if isinstance(item, str):
+                            yield item
+                            continue
+                        # final images
+                        result, item_usage = item
+                        results.append(result)
+                        for key, val in (item_usage or {}).items():
+                            if isinstance(val, int):
+                                usage[key] = usage.get(key, 0) + val
+                else:
+                    extractor = await self._request_images(client=client, payload=payload, fields={"b64_json"})
+                    try:
+                        response = extractor.result()
+
+                        # upload image
+                        results = await self._upload_images(
+                            __request__=__request__,
+                            user=user,
+                            images=[(extractor.file(item["b64_json"]), "image/png") for item in response["data"]],
+                        )
+                    finally:
+                        extractor.close()
+
+                    # format response data
+                    usage = response.get("usage", None)
+            # an empty result is never cached, the next request generates again
+            if cache_key and results:
+                await loop.run_in_executor(
+                    self.upload_executor,
+                    partial(
+                        self.result_cache.set, cache_key, json.dumps(results), ttl=self.valves.result_cache_ttl * 3600
+                    ),
                 )
 
-            # format response data
-            usage = response.get("usage", None)
+        # response
+        content = "\n\n".join(results)
+        if body.get("stream"):
+            yield self._format_data(is_stream=True, model=model, content=content, usage=None)
+            yield self._format_data(is_stream=True, model=model, content=None, usage=usage)
+        else:
+            yield self._format_data(is_stream=False, model=model, content=content, usage=usage)
+
+    async def _stream_images(
+        self, client: httpx.AsyncClient, payload: dict, __request__: Request, user: UserModel, is_stream: bool
+    ) -> AsyncIterable:
+        # status and preview events are sse frames, only sent to streaming callers
+        if is_stream:
+            yield self._format_status(description="Generating image", done=False)
+        results = []
+        async with client.stream("POST", **payload) as response:
+            if response.status_code != 200:
+                text = ""
+                async for line in response.aiter_lines():
+                    text += line  # pylint: disable=R1713
+                logger.error("response invalid with %d: %s", response.status_code, text)
+                raise APIException(status=response.status_code, content=text, response=response)
+            async for line in response.aiter_lines():
+                line = line.strip()
+                if not line.startswith("data:"):
+                    continue
+                line = line[5:].strip()
+                if not line or line == "[DONE]":
+                    continue
+                event = json.loads(line)
+                event_type = event.get("type", "")
+                mime_type = f"image/{event.get('output_format') or 'png'}"
+                # partial frame, a small inline preview after the finished images until the final image arrives
+                if event_type.endswith(".partial_image"):
+                    if not is_stream:
+                        continue
+                    loop = asyncio.get_running_loop()
+                    preview = await loop.run_in_executor(self.upload_executor, self._preview_image, event["b64_json"])
+                    if preview:
+                        data = {"event": {"type": "replace", "data": {"content": "\n\n".join(results + [preview])}}}
+                        yield f"data: {json.dumps(data)}\n\n"
+                    yield self._format_status(
+                        description=f"Generating image (preview {event.get('partial_image_index', 0) + 1})",
+                        done=False,
+                    )
+                # final image
+                elif event_type.endswith(".completed"):
+                    result = await self._upload_images(
+                        __request__=__request__, user=user, images=[(event["b64_json"], mime_type)]
+                    )
+                    results.append(result[0])
+                    if is_stream:
+                        data = {"event": {"type": "replace", "data": {"content": "\n\n".join(results)}}}
+                        yield f"data: {json.dumps(data)}\n\n"
+                    yield result[0], event.get("usage")
+                elif event_type == "error":
+                    raise APIException(status=response.status_code, content=line, response=response)
+        if is_stream:
+            yield self._format_status(description="Image generated", done=True)
+
+    def _preview_image(self, image_data: str) -> str:
+        # previews are never stored as files, only a downscaled copy is shown inline
+        try:
+            with Image.open(io.BytesIO(base64.b64decode(image_data))) as image:
+                image.thumbnail((PREVIEW_MAX_SIZE, PREVIEW_MAX_SIZE), Image.Resampling.LANCZOS)
+                if image.mode not in ("RGB", "RGBA"):
+                    image = image.convert("RGBA")
+                buffer = io.BytesIO()
+                image.save(buffer, format="WEBP", quality=60)
+        except Exception as err:
+            logger.warning("[%s] preview encode failed: %s", self.__class__.__name__, err)
+            return ""
+        return f"![preview](data:image/webp;base64,{base64.b64encode(buffer.getvalue()).decode()})"
 
-            # response
-            content = "\n\n".join(results)
-            if body.get("stream"):
-                yield self._format_data(is_stream=True, model=model, content=content, usage=None)
-                yield self._format_data(is_stream=True, model=model, content=None, usage=usage)
-            else:
-                yield self._format_data(is_stream=False, model=model, content=content, usage=usage)
+    def _result_cache_key(self, user: UserModel, payload: dict) -> str:
+        hasher = hashlib.blake2b(digest_size=32)
+        params = payload.get("json") or payload.get("data") or {}
+        hasher.update(json.dumps({"url": payload["url"], "params": params}, sort_keys=True).encode())
+        # reference images
+        for _, file in payload.get("files", []):
+            hasher.update(hashlib.blake2b(file[1], digest_size=32).digest())
+        return f"{user.id}:{hasher.hexdigest()}"
+
+    def _get_cached_result(self, cache_key: str) -> Optional[List[str]]:
+        cached = self.result_cache.get(cache_key)
+        if not cached:
+            return None
+        results = json.loads(cached)
+        if not results:
+            return None
+        # the stored files may have been deleted since
+        for result in results:
+            file_id = result.split("-image-", 1)[1].split("]", 1)[0]
+            if not Files.get_file_by_id(file_id):
+                return None
+        return results
+
+    async def _request_images(self, client: httpx.AsyncClient, payload: dict, fields: Set[str]) -> Base64FieldExtractor:
+        # decode base64 fields while reading so that images are never held as json strings
+        async with client.stream("POST", **payload) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise APIException(status=response.status_code, content=response.text, response=response)
+            extractor = Base64FieldExtractor(fields=fields)
+            try:
+                async for chunk in response.aiter_bytes():
+                    extractor.feed(chunk)
+            except BaseException:
+                extractor.close()
+                raise
+            return extractor
+
+    async def _upload_images(
+        self, __request__: Request, user: UserModel, images: List[Tuple[Union[str, BinaryIO], str]]
+    ) -> List[str]:
+        # decode and persist images concurrently without blocking the event loop
+        loop = asyncio.get_running_loop()
+        return list(
+            await asyncio.gather(
+                *[
+                    loop.run_in_executor(
+                        self.upload_executor,
+                        partial(
+                            self._upload_image,
+                            __request__=__request__,
+                            user=user,
+                            image_data=image_data,
+                            mime_type=mime_type,
+                        ),
+                    )
+                    for image_data, mime_type in images
+                ]
+            )
+        )
+
+    def _upload_image(
+        self, __request__: Request, user: UserModel, image_data: Union[str, BinaryIO], mime_type: str
+    ) -> str:
+        image_file = io.BytesIO(base64.b64decode(image_data)) if isinstance(image_data, str) else image_data
+        # hash in chunks so that spooled images are never fully loaded for it
+        hasher = hashlib.blake2b(digest_size=32)
+        for chunk in iter(partial(image_file.read, SPOOL_MAX_SIZE), b""):
+            hasher.update(chunk)
+        image_file.seek(0)
+        # reuse the stored file when the same image has been persisted before
+        index_key = f"{user.id}:{hasher.hexdigest()}"
+        indexed = self.image_index.get(index_key) if self.valves.enable_dedupe else None
+        if indexed:
+            file_id, _, thumbnail_id = indexed.partition(",")
+            if Files.get_file_by_id(file_id):
+                return self._render_image(__request__, file_id, thumbnail_id)
+        # re-encode and build the thumbnail in the worker
+        source_file = image_file
+        image_file, mime_type, thumbnail_file = self._encode_output(image_file, mime_type)
+        try:
+            file_id = self._store_file(__request__, user, image_file, mime_type)
+            thumbnail_id = self._store_file(__request__, user, thumbnail_file, "image/webp") if thumbnail_file else ""
+            # keep the stored version for later edit turns
+            image_file.seek(0, io.SEEK_END)
+            image_size = image_file.tell()
+            image_file.seek(0)
+            self._cache_image(user, file_id, image_file, image_size, mime_type)
+        finally:
+            if image_file is not source_file:
+                image_file.close()
+            if thumbnail_file is not None:
+                thumbnail_file.close()
+        if self.valves.enable_dedupe:
+            self.image_index.set(
+                index_key,
+                f"{file_id},{thumbnail_id}" if thumbnail_id else file_id,
+                ttl=self.valves.dedupe_ttl * 86400,
+            )
+        return self._render_image(__request__, file_id, thumbnail_id)
 
-    def _upload_image(self, __request__: Request, user: UserModel, image_data: str, mime_type: str) -> str:
+    def _store_file(self, __request__: Request, user: UserModel, image_file: BinaryIO, mime_type: str) -> str:
         file_item = upload_file(
             request=__request__,
             background_tasks=BackgroundTasks(),
             file=UploadFile(
-                file=io.BytesIO(base64.b64decode(image_data)),
-                filename=f"generated-image-{uuid.uuid4().hex}.png",
+                file=image_file,
+                filename=f"generated-image-{uuid.uuid4().hex}.{mime_type.split('/')[-1]}",
                 headers=Headers({"content-type": mime_type}),
             ),
             process=False,
             user=user,
             metadata={"mime_type": mime_type},
         )
-        image_url = __request__.app.url_path_for("get_file_content_by_id", id=file_item.id)
-        return f"![openai-image-{file_item.id}]({image_url})"
+        return file_item.id
 
-    async def _get_image_content(self, user: UserModel, markdown_string: str):
+    def _render_image(self, __request__: Request, file_id: str, thumbnail_id: str) -> str:
+        image_url = __request__.app.url_path_for("get_file_content_by_id", id=file_id)
+        if not thumbnail_id:
+            return f"![openai-image-{file_id}]({image_url})"
+        thumbnail_url = __request__.app.url_path_for("get_file_content_by_id", id=thumbnail_id)
+        return f"[![openai-image-{file_id}]({thumbnail_url})]({image_url})"
+
+    def _encode_output(self, image_file: BinaryIO, mime_type: str) -> Tuple[BinaryIO, str, Optional[BinaryIO]]:
+        output_format = self.valves.output_format
+        thumbnail_size = self.valves.thumbnail_size
+        if output_format == "original" and thumbnail_size <= 0:
+            return image_file, mime_type, None
+        try:
+            with Image.open(image_file) as image:
+                image.load()
+                if image.mode not in ("RGB", "RGBA"):
+                    image = image.convert("RGBA")
+                # full size image
+                if output_format != "original":
+                    output_file = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+                    try:
+                        image.save(output_file, format=output_format.upper(), quality=self.valves.output_quality)
+                    except (KeyError, OSError):
+                        logger.warning("[%s] %s encoder unavailable, use webp", self.__class__.__name__, output_format)
+                        output_format = "webp"
+                        output_file.seek(0)
+                        output_file.truncate()
+                        image.save(output_file, format="WEBP", quality=self.valves.output_quality)
+                    output_file.seek(0)
+                    image_file, mime_type = output_file, f"image/{output_format}"
+                # thumbnail
+                thumbnail_file = None
+                if thumbnail_size > 0:
+                    image.thumbnail((thumbnail_size, thumbnail_size), Image.Resampling.LANCZOS)
+                    thumbnail_file = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+                    image.save(thumbnail_file, format="WEBP", quality=80)
+                    thumbnail_file.seek(0)
+        except Exception as err:
+            logger.warning("[%s] image encode failed: %s", self.__class__.__name__, err)
+            image_file.seek(0)
+            return image_file, mime_type, None
+        return image_file, mime_type, thumbnail_file
+
+    async def _get_image_content(self, user: UserModel, markdown_string: str) -> Tuple[bytes, str]:
         file_id = markdown_string.split("![openai-image-")[1].split("]")[0]
+        cache_key = self._image_cache_key(user, file_id)
+        cached = self.image_cache.get(cache_key)
+        if cached is not None:
+            return cached
         file_response = await get_file_content_by_id(id=file_id, user=user)
-        return open(file_response.path, "rb")
+        loop = asyncio.get_running_loop()
+        image_bytes = await loop.run_in_executor(self.upload_executor, self._read_file, file_response.path)
+        mime_type = file_response.media_type or "image/png"
+        self.image_cache.set(cache_key, image_bytes, mime_type)
+        return image_bytes, mime_type
+
+    def _cache_image(
+        self, user: UserModel, file_id: str, image_file: BinaryIO, image_size: int, mime_type: str
+    ) -> None:
+        if image_size > self.image_cache.max_bytes:
+            return
+        self.image_cache.set(self._image_cache_key(user, file_id), image_file.read(), mime_type)
+
+    async def _prepare_reference(self, image_data: str, mime_type: str) -> Tuple[bytes, str]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.upload_executor, self._preprocess_image, image_data, mime_type)
+
+    def _preprocess_image(self, image_data: str, mime_type: str) -> Tuple[bytes, str]:
+        image_bytes = base64.b64decode(image_data)
+        if self.valves.reference_max_size <= 0:
+            return image_bytes, mime_type
+        cache_key = self._reference_cache_key(image_bytes)
+        cached = self.reference_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        image_bytes, mime_type = self._transcode_image(image_bytes, mime_type)
+        self.reference_cache.set(cache_key, image_bytes, mime_type)
+        return image_bytes, mime_type
+
+    def _transcode_image(self, image_bytes: bytes, mime_type: str) -> Tuple[bytes, str]:
+        max_size = self.valves.reference_max_size
+        image_format = self.valves.reference_format
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                image = ImageOps.exif_transpose(image)
+                resized = max(image.size) > max_size
+                if resized:
+                    image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+                if image_format == "jpeg" and image.mode != "RGB":
+                    image = image.convert("RGB")
+                elif image.mode not in ("RGB", "RGBA"):
+                    image = image.convert("RGBA")
+                buffer = io.BytesIO()
+                image.save(buffer, format=image_format.upper(), quality=self.valves.reference_quality)
+        except Exception as err:
+            logger.warning("[%s] reference image preprocess failed: %s", self.__class__.__name__, err)
+            return image_bytes, mime_type
+        # keep the original when re-encoding does not make it smaller
+        if not resized and buffer.tell() >= len(image_bytes):
+            return image_bytes, mime_type
+        return buffer.getvalue(), f"image/{image_format}"
+
+    def _reference_cache_key(self, image_bytes: bytes) -> str:
+        digest = hashlib.blake2b(image_bytes, digest_size=32).hexdigest()
+        return (
+            f"{digest}:{self.valves.reference_max_size}:{self.valves.reference_format}:{self.valves.reference_quality}"
+        )
+
+    def _read_file(self, path: str) -> bytes:
+        with open(path, "rb") as file:
+            return file.read()
+
+    def _image_cache_key(self, user: UserModel, file_id: str) -> str:
+        # scope by user so that cached files never bypass the file access check
+        return f"{user.id}:{file_id}"
 
     async def _build_payload(self, user: UserModel, body: dict, user_valves: UserValves) -> (str, dict):
         # payload
@@ -162,8 +727,10 @@ class Pipe:
                 for item in message_content.split("\n"):
                     if not item:
                         continue
-                    if item.startswith("![openai-image-"):
-                        data["image"].append(await self._get_image_content(user, item))
+                    if item.lstrip("[").startswith("![openai-image-"):
+                        image_bytes, mime_type = await self._get_image_content(user, item)
+                        file_name = f"{uuid.uuid4().hex}.{mime_type.split('/')[-1]}"
+                        data["image"].append((file_name, image_bytes, mime_type, {"content-type": mime_type}))
                         continue
                     data["prompt"] += f"\n{message_content}"
             # list content
@@ -176,8 +743,8 @@ class Pipe:
                         image_url = content["image_url"]["url"]
                         header, encoded = image_url.split(",", 1)
                         mime_type = header.split(";")[0].split(":")[1]
+                        image_bytes, mime_type = await self._prepare_reference(encoded, mime_type)
                         file_name = f"{uuid.uuid4().hex}.{mime_type.split('/')[-1]}"
-                        image_bytes = base64.b64decode(encoded.encode())
                         data["image"].append(
                             (
                                 file_name,
@@ -189,6 +756,11 @@ class Pipe:
             else:
                 raise TypeError("message content invalid")
 
+        # stream partial images
+        if self.valves.partial_images > 0:
+            data["stream"] = True
+            data["partial_images"] = self.valves.partial_images
+
         # init payload
         if data["image"]:
             files = data.pop("image")
@@ -199,6 +771,10 @@ class Pipe:
 
         return model, payload
 
+    def _format_status(self, description: str, done: bool) -> str:
+        data = {"event": {"type": "status", "data": {"description": description, "done": done}}}
+        return f"data: {json.dumps(data)}\n\n"
+
     def _format_data(
         self,
         is_stream: bool,
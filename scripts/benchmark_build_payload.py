@@ -0,0 +1,84 @@
+"""
+Benchmark _build_payload of the chat pipes on long conversations with images.
+
+usage: python scripts/benchmark_build_payload.py [--turns 200] [--image-every 10] [--image-kb 600] [--rounds 10]
+"""
+
+import argparse
+import asyncio
+import base64
+import importlib.util
+import json
+import os
+import statistics
+import time
+from pathlib import Path
+
+PIPES = ["claude_messages", "gemini_chat", "openai_responses", "grok_responses"]
+PIPE_DIR = Path(__file__).resolve().parent.parent / "pipes"
+
+
+def load_pipe(name: str):
+    spec = importlib.util.spec_from_file_location(name, PIPE_DIR / f"{name}.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Pipe()
+
+
+def build_body(turns: int, image_every: int, image_kb: int) -> dict:
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for turn in range(turns):
+        content = [{"type": "text", "text": f"question {turn} " + "lorem ipsum " * 40}]
+        if image_every and turn % image_every == 0:
+            image = base64.b64encode(os.urandom(image_kb * 1024)).decode()
+            content.append({"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image}"}})
+        messages.append({"role": "user", "content": content})
+        messages.append({"role": "assistant", "content": f"answer {turn} " + "dolor sit amet " * 120})
+    return {"model": "bench.model", "messages": messages}
+
+
+def fresh_body(body: dict) -> dict:
+    # every request arrives as a newly parsed json body
+    return json.loads(json.dumps(body))
+
+
+async def bench_pipe(pipe, body: dict, rounds: int) -> dict:
+    build_times, encode_times = [], []
+    for _ in range(rounds):
+        request_body = fresh_body(body)
+        start = time.perf_counter()
+        _, payload = await pipe._build_payload(body=request_body, user_valves=pipe.UserValves())
+        build_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        json.dumps(payload["json"])
+        encode_times.append(time.perf_counter() - start)
+    return {
+        "build_ms": statistics.median(build_times) * 1000,
+        "encode_ms": statistics.median(encode_times) * 1000,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--image-every", type=int, default=10)
+    parser.add_argument("--image-kb", type=int, default=600)
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    body = build_body(args.turns, args.image_every, args.image_kb)
+    body_size = len(json.dumps(body)) / 1024 / 1024
+    print(f"{args.turns} turns, {len(body['messages'])} messages, body {body_size:.1f} MB, median of {args.rounds}")
+    print(f"{'pipe':<20}{'build (ms)':>12}{'json encode (ms)':>20}")
+    for name in PIPES:
+        try:
+            pipe = load_pipe(name)
+        except ImportError as err:
+            print(f"{name:<20}skipped: {err}")
+            continue
+        result = await bench_pipe(pipe, body, args.rounds)
+        print(f"{name:<20}{result['build_ms']:>12.2f}{result['encode_ms']:>20.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())